@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Deploy the image analyzer to every endpoint of one or more environments in parallel
+
+Creates the model, updates all endpoints concurrently and polls their status with
+backoff instead of sleeping for fixed periods, then checks the deployed image digest of
+every endpoint like verify_deployment.py. A deploy takes as long as the slowest endpoint.
+The SageMaker and ECR clients are passed in, so the steps can run against stubbed APIs.
+"""
+
+import boto3
+import argparse
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+from verify_deployment import get_ecr_latest_digest, get_sagemaker_deployed_digest
+
+REGION = 'us-east-1'
+
+ACCOUNTS = {
+    'dev': ('722568544242', 'arn:aws:iam::722568544242:role/aws-sagemaker-role'),
+    'stage': ('517812868058', 'arn:aws:iam::517812868058:role/aws-sagemaker-role'),
+    'prod': ('770820631445', 'arn:aws:iam::770820631445:role/dme-sagemaker-role'),
+}
+
+# Instance type of each endpoint, by the suffix of its name
+INSTANCE_TYPES = {
+    'C6i2x': 'ml.c6i.2xlarge',
+    'C5i': 'ml.c5.large',
+}
+
+SETTLING_STATUSES = ('Creating', 'Updating', 'SystemUpdating', 'RollingBack', 'Deleting')
+
+def model_environment(env):
+    """The environment whose account, model and repository an environment deploys from"""
+    return 'dev' if env == 'test' else env
+
+def model_name(env):
+    return 'defenderImageAnalyzerPersonal' if env == 'personal' else 'defenderImageAnalyzer'
+
+def repository_name(env):
+    return 'defender-image-analyzer-personal' if env == 'personal' else 'defender-image-analyzer'
+
+def endpoint_names(env):
+    """Endpoint name -> instance type of an environment"""
+    if env == 'personal':
+        return {'defenderImageAnalyzerPersonalC5i': INSTANCE_TYPES['C5i']}
+    suffix = '-test' if env == 'test' else ''
+    return {f'defenderImageAnalyzerEndpoint{name}{suffix}': instance for name, instance in INSTANCE_TYPES.items()}
+
+def personal_account(session):
+    """Account id and SageMaker execution role of the current credentials"""
+    account_id = session.client('sts').get_caller_identity()['Account']
+    iam = session.client('iam')
+    for role_name in ('SageMaker-ExecutionRole', 'AmazonSageMaker-ExecutionRole',
+                      f'SageMaker-ExecutionRole-{account_id}', 'service-role/SageMakerRole'):
+        try:
+            iam.get_role(RoleName=role_name.split('/')[-1])
+            return account_id, f'arn:aws:iam::{account_id}:role/{role_name}'
+        except iam.exceptions.NoSuchEntityException:
+            continue
+    return account_id, f'arn:aws:iam::{account_id}:role/SageMaker-ExecutionRole'
+
+class Poller:
+    """Call a function until its result is accepted, with exponential backoff and jitter"""
+
+    def __init__(self, initial=2, maximum=30, factor=1.5, timeout=3600, sleep=time.sleep, clock=time.monotonic):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+
+    def until(self, fn, accept, what):
+        deadline = self.clock() + self.timeout
+        delay = self.initial
+        while True:
+            result = fn()
+            if accept(result):
+                return result
+            if self.clock() + delay > deadline:
+                raise TimeoutError(f"Timed out after {self.timeout:.0f}s waiting for {what}")
+            # Jitter keeps parallel pollers from calling the API in lockstep
+            self.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(self.maximum, delay * self.factor)
+
+def _is_missing(error):
+    return error.response['Error']['Code'] in ('ValidationException', 'ResourceNotFound')
+
+def describe_endpoint(sagemaker, endpoint_name):
+    """describe_endpoint, or None if the endpoint does not exist"""
+    try:
+        return sagemaker.describe_endpoint(EndpointName=endpoint_name)
+    except ClientError as e:
+        if _is_missing(e):
+            return None
+        raise
+
+def recreate_model(sagemaker, name, image_url, role, poller):
+    """Delete the model if it exists, wait until it is gone and create it with image_url"""
+    try:
+        sagemaker.describe_model(ModelName=name)
+        print(f'Model {name} already exists. Deleting...')
+        sagemaker.delete_model(ModelName=name)
+
+        def model_exists():
+            try:
+                sagemaker.describe_model(ModelName=name)
+                return True
+            except ClientError as e:
+                if _is_missing(e):
+                    return False
+                raise
+
+        poller.until(model_exists, lambda exists: not exists, f'model {name} to be deleted')
+        print(f'Model {name} deleted.')
+    except ClientError as e:
+        if not _is_missing(e):
+            raise
+        print(f'Model {name} does not exist. Creating new one...')
+
+    response = sagemaker.create_model(
+        ModelName=name,
+        PrimaryContainer={
+            'Image': image_url,
+            'Environment': {
+                'SAGEMAKER_PROGRAM': 'image-analyzer.py',
+                'FORCE_REFRESH': str(int(time.time()))  # Timestamp to force refresh
+            }
+        },
+        ExecutionRoleArn=role
+    )
+    print(f'✅ Model created: {response["ModelArn"]}')
+    return response
+
+def update_endpoint(sagemaker, endpoint_name, instance_type, model, poller, timestamp):
+    """Point an endpoint at a new config for model, creating it if needed, and wait until it is InService"""
+    config_name = f'{endpoint_name}-{timestamp}'
+    sagemaker.create_endpoint_config(
+        EndpointConfigName=config_name,
+        ProductionVariants=[{
+            'InstanceType': instance_type,
+            'InitialInstanceCount': 1,
+            'ModelName': model,
+            'VariantName': 'AllTraffic'
+        }]
+    )
+
+    endpoint = describe_endpoint(sagemaker, endpoint_name)
+    if endpoint is not None and endpoint['EndpointStatus'] in SETTLING_STATUSES:
+        print(f"[{endpoint_name}] {endpoint['EndpointStatus']}, waiting for it to settle...")
+        endpoint = poller.until(
+            lambda: describe_endpoint(sagemaker, endpoint_name),
+            lambda e: e is None or e['EndpointStatus'] not in SETTLING_STATUSES,
+            f'{endpoint_name} to settle'
+        )
+
+    if endpoint is None:
+        print(f'[{endpoint_name}] Creating with {config_name}')
+        sagemaker.create_endpoint(EndpointName=endpoint_name, EndpointConfigName=config_name)
+    else:
+        print(f'[{endpoint_name}] Updating to {config_name}')
+        sagemaker.update_endpoint(EndpointName=endpoint_name, EndpointConfigName=config_name)
+
+    start = time.monotonic()
+    endpoint = poller.until(
+        lambda: describe_endpoint(sagemaker, endpoint_name),
+        lambda e: e is not None and e['EndpointStatus'] not in SETTLING_STATUSES,
+        f'{endpoint_name} to be InService'
+    )
+    reason = endpoint.get('FailureReason', 'unknown reason')
+    if endpoint['EndpointStatus'] == 'Failed':
+        raise Exception(f"Endpoint {endpoint_name} failed: {reason}")
+    # A failed update is rolled back: the endpoint is InService again on its previous config
+    if endpoint['EndpointConfigName'] != config_name:
+        raise Exception(f"Endpoint {endpoint_name} rolled back to {endpoint['EndpointConfigName']}: {reason}")
+    print(f'[{endpoint_name}] InService after {time.monotonic() - start:.0f}s')
+
+def deploy_endpoint(sagemaker, endpoint_name, instance_type, model, expected_digest, poller, timestamp):
+    """Update one endpoint and verify the digest of the image it runs; returns (ok, message)"""
+    try:
+        update_endpoint(sagemaker, endpoint_name, instance_type, model, poller, timestamp)
+        deployed_digest = get_sagemaker_deployed_digest(sagemaker, endpoint_name)
+    except Exception as e:
+        return False, f'💥 {e}'
+    if expected_digest and deployed_digest != expected_digest:
+        return False, f'❌ Image digest mismatch: expected {expected_digest}, running {deployed_digest}'
+    return True, f'✅ Running {deployed_digest}'
+
+def deploy(sagemaker, ecr, envs, image_digest=None, registry=None, role=None, poller=None, max_workers=None):
+    """Create the model and deploy it to every endpoint of envs in parallel.
+
+    All envs must share one model (dev and test, or a single environment). Returns a
+    dict of endpoint name -> (ok, message).
+    """
+    poller = poller or Poller()
+    env = model_environment(envs[0])
+    if any(model_environment(other) != env for other in envs):
+        raise ValueError(f"Environments {', '.join(envs)} do not share a model")
+
+    repository = repository_name(env)
+    if image_digest is None:
+        image_digest = get_ecr_latest_digest(ecr, repository)
+        print(f'Using latest image digest from ECR: {image_digest}')
+    image_url = f'{registry}/{repository}@{image_digest}'
+    recreate_model(sagemaker, model_name(env), image_url, role, poller)
+
+    endpoints = {}
+    for name in envs:
+        endpoints.update(endpoint_names(name))
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    with ThreadPoolExecutor(max_workers=max_workers or len(endpoints)) as executor:
+        futures = {
+            endpoint: executor.submit(
+                deploy_endpoint, sagemaker, endpoint, instance_type, model_name(env), image_digest, poller, timestamp
+            )
+            for endpoint, instance_type in endpoints.items()
+        }
+        return {endpoint: future.result() for endpoint, future in futures.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the model and update all endpoints in parallel")
+    parser.add_argument('--env', nargs='+', default=['dev'], choices=['dev', 'stage', 'prod', 'test', 'personal'],
+                        help='Environments to deploy, e.g. "--env dev test"; they must share an account')
+    parser.add_argument('--image-digest', help='Image digest to deploy (default: the latest tag in ECR)')
+    parser.add_argument('--region', default=REGION, help='AWS region')
+    parser.add_argument('--timeout', type=float, default=3600, help='Seconds to wait for each endpoint')
+    args = parser.parse_args()
+
+    session = boto3.session.Session(region_name=args.region)
+    sagemaker = session.client('sagemaker')
+    ecr = session.client('ecr')
+    env = model_environment(args.env[0])
+    if env == 'personal':
+        account_id, role = personal_account(session)
+    else:
+        account_id, role = ACCOUNTS[env]
+    registry = f'{account_id}.dkr.ecr.{args.region}.amazonaws.com'
+
+    print(f"🚀 Deploying to: {', '.join(args.env)}")
+    start = time.monotonic()
+    try:
+        results = deploy(sagemaker, ecr, args.env, args.image_digest, registry, role, Poller(timeout=args.timeout))
+    except Exception as e:
+        print(f"💥 ERROR: {e}")
+        sys.exit(1)
+
+    print("-" * 50)
+    for endpoint, (ok, message) in results.items():
+        print(f'{endpoint}: {message}')
+    print(f'Finished in {time.monotonic() - start:.0f}s')
+    sys.exit(0 if all(ok for ok, _ in results.values()) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,49 @@
 import pip
 pip.main(["install", "tf_keras"]) # https://github.com/serengil/deepface/issues/1121#issuecomment-2004264510 workaround for missing tf_keras issue from the latest tensorflow (> 2.16)
 
-from flask import Flask, request, jsonify
-from deepface import DeepFace
+import os
+
+# Low-memory mode: reduced-precision recognition weights, a smaller oneDNN primitive cache,
+# one inter-op thread and prompt release of per-request buffers. TensorFlow's CPU allocator
+# itself is not bounded. These settings are read when TensorFlow is imported, so they have
+# to be set before deepface is.
+LOW_MEMORY = os.environ.get('LOW_MEMORY', '0') == '1'
+LOW_MEMORY_WEIGHTS = os.environ.get('LOW_MEMORY_WEIGHTS', 'int8')  # int8 or float16
+LOW_MEMORY_MIN_COSINE = float(os.environ.get('LOW_MEMORY_MIN_COSINE', '0.995'))
+if LOW_MEMORY:
+    os.environ.setdefault('ONEDNN_PRIMITIVE_CACHE_CAPACITY', '64')
+    os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from deepface.modules import detection, modeling, preprocessing
+from deepface.models.Detector import FacialAreaRegion
+from PIL import Image, ImageSequence
 import boto3
-import json
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import numpy as np
+import cv2
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from functools import partial
 from uuid import uuid4
+import ctypes
+import gc
+import hashlib
+import io
+import json
+import queue
+import re
+import resource
+import socket
+import ssl
+import struct
 import tempfile
-import os
+import threading
+import time
+import urllib.parse
 import logging
 
 # Set up logging
@@ -17,43 +53,2250 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Optional libjpeg-turbo binding (pip install PyTurboJPEG); OpenCV's reduced decode is used without it
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbojpeg = TurboJPEG()
+except Exception:  # binding or the libturbojpeg shared library is not installed
+    _turbojpeg = None
+
+try:
+    _libc = ctypes.CDLL('libc.so.6')
+except OSError:
+    _libc = None
+
 app = Flask(__name__)
-s3 = boto3.client('s3')
+
+# Admission control. Each worker runs at most MAX_INFLIGHT inferences and lets MAX_QUEUE
+# more requests (of all lanes) wait for a slot; anything beyond that is rejected immediately with 429
+# instead of sitting in the socket backlog until SageMaker's invocation timeout.
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', '8'))
+MAX_INFLIGHT = int(os.environ.get('MAX_INFLIGHT', '1'))
+MAX_QUEUE = int(os.environ.get('MAX_QUEUE', str(max(0, GUNICORN_THREADS - MAX_INFLIGHT))))
+REQUEST_TIMEOUT_S = float(os.environ.get('REQUEST_TIMEOUT_S', '55'))  # SageMaker gives up after 60 s
+MAX_IMAGE_MB = float(os.environ.get('MAX_IMAGE_MB', '25'))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', '50000000'))
+MAX_BATCH_KEYS = int(os.environ.get('MAX_BATCH_KEYS', '100'))
+
+# Optional CloudWatch publishing of the saturation metrics, for SageMaker autoscaling
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE')
+METRICS_INTERVAL_S = float(os.environ.get('METRICS_INTERVAL_S', '60'))
+ENDPOINT_NAME = os.environ.get('ENDPOINT_NAME', 'local')
+
+class RequestRejected(Exception):
+    """A request refused before or while being processed, returned with its HTTP status"""
+    status = 503
+
+class QueueFull(RequestRejected):
+    status = 429
+
+class ImageTooLarge(RequestRejected):
+    status = 413
+
+class DeadlineExceeded(RequestRejected):
+    status = 504
+
+class BadRequest(RequestRejected):
+    status = 400
+
+class Deadline:
+    """Point in time after which the caller has given up on a request"""
+
+    def __init__(self, timeout):
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self, stage):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Request deadline exceeded before {stage}")
+
+# Priority lanes. Requests carry "priority": "interactive" (default) or "bulk", and each
+# lane has its own bounded queue. Freed slots go to the lanes by weighted round-robin
+# (LANE_WEIGHTS) or, with LANE_SCHEDULING=strict, to bulk only when no interactive request
+# waits. The lanes split MAX_QUEUE between them, so together they never wait on more
+# requests than the worker has gunicorn threads, and the bulk share is small by default.
+LANES = ('interactive', 'bulk')
+DEFAULT_PRIORITY = os.environ.get('DEFAULT_PRIORITY', 'interactive')
+MAX_BULK_QUEUE = min(MAX_QUEUE, int(os.environ.get('MAX_BULK_QUEUE', str(MAX_QUEUE // 4))))
+LANE_QUEUES = {'interactive': MAX_QUEUE - MAX_BULK_QUEUE, 'bulk': MAX_BULK_QUEUE}
+LANE_SCHEDULING = os.environ.get('LANE_SCHEDULING', 'weighted')  # weighted or strict
+LANE_WEIGHTS = dict(
+    (lane.strip(), int(weight)) for lane, weight in
+    (item.split(':') for item in os.environ.get('LANE_WEIGHTS', 'interactive:4,bulk:1').split(','))
+)
+
+def _percentile_ms(samples, q):
+    return round(1000 * samples[int(q * (len(samples) - 1))], 1) if samples else 0.0
+
+class _Lane:
+    """Waiting requests and wait/latency statistics of one priority lane"""
+
+    def __init__(self, max_queue, weight, window):
+        self.max_queue = max_queue
+        self.weight = weight
+        self.current_weight = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = deque(maxlen=window)  # seconds waited by the most recent admissions
+        self.latencies = deque(maxlen=window)  # seconds from arrival to release
+
+    def snapshot(self):
+        waits, latencies = sorted(self.waits), sorted(self.latencies)
+        return {
+            "queue_depth": len(self.waiting),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms_avg": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+            "wait_ms_p99": _percentile_ms(waits, 0.99),
+            "latency_ms_p50": _percentile_ms(latencies, 0.5),
+            "latency_ms_p99": _percentile_ms(latencies, 0.99)
+        }
+
+class Slot:
+    """An inference slot requested by one request; release() gives it back once granted"""
+
+    def __init__(self, controller, lane):
+        self.controller = controller
+        self.lane = lane
+        self.arrived = time.monotonic()
+        self.granted = False
+        self.released = False
+
+    def release(self):
+        self.controller.release(self)
+
+    def renew(self, deadline):
+        """This slot while it is held, or a new slot in the same lane once it was released"""
+        if not self.released:
+            return self
+        return self.controller.acquire(deadline, self.lane, requeue=True)
+
+class AdmissionController:
+    """Per-worker priority queues in front of inference, with queue depth and wait metrics"""
+
+    def __init__(self, max_inflight, lanes, scheduling='weighted', window=1000):
+        self.max_inflight = max(1, max_inflight)
+        self.scheduling = scheduling
+        # lanes maps each lane, highest priority first, to its (max_queue, weight)
+        self.lanes = {name: _Lane(max_queue, weight, window) for name, (max_queue, weight) in lanes.items()}
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, deadline, lane=DEFAULT_PRIORITY, requeue=False):
+        """Wait for an inference slot, or raise if the lane's queue is full or the deadline passes.
+
+        requeue is for a request that already held a slot and gave it back between images:
+        it is already counted against the threads, so a full queue does not turn it away.
+        """
+        with self._cond:
+            state = self.lanes[lane]
+            if not requeue and self.inflight >= self.max_inflight and len(state.waiting) >= state.max_queue:
+                state.rejected += 1
+                raise QueueFull(f"Worker {lane} queue is full ({len(state.waiting)} waiting)")
+            slot = Slot(self, lane)
+            state.waiting.append(slot)
+            self._dispatch()
+            while not slot.granted:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    state.waiting.remove(slot)
+                    state.timed_out += 1
+                    raise RequestRejected("Timed out waiting for an inference slot")
+                self._cond.wait(remaining)
+            state.admitted += 1
+            state.waits.append(time.monotonic() - slot.arrived)
+            return slot
+
+    def release(self, slot):
+        with self._cond:
+            if slot.released:
+                return
+            slot.released = True
+            self.inflight -= 1
+            self.lanes[slot.lane].latencies.append(time.monotonic() - slot.arrived)
+            self._dispatch()
+
+    def _next_lane(self):
+        ready = [lane for lane in self.lanes.values() if lane.waiting]
+        if self.scheduling == 'strict' or len(ready) < 2:
+            return ready[0] if ready else None
+        # Smooth weighted round-robin: each lane gets its share of slots, evenly interleaved
+        total = sum(lane.weight for lane in ready)
+        for lane in ready:
+            lane.current_weight += lane.weight
+        best = max(ready, key=lambda lane: lane.current_weight)
+        best.current_weight -= total
+        return best
+
+    def _dispatch(self):
+        """Hand free slots to waiting requests, choosing lanes by the scheduling policy"""
+        granted = False
+        while self.inflight < self.max_inflight:
+            lane = self._next_lane()
+            if lane is None:
+                break
+            lane.waiting.popleft().granted = True
+            self.inflight += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, deadline, lane=DEFAULT_PRIORITY, requeue=False):
+        slot = self.acquire(deadline, lane, requeue)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def snapshot(self):
+        with self._cond:
+            lanes = {name: lane.snapshot() for name, lane in self.lanes.items()}
+            waits = sorted(wait for lane in self.lanes.values() for wait in lane.waits)
+            return {
+                "pid": os.getpid(),
+                "queue_depth": sum(lane["queue_depth"] for lane in lanes.values()),
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "max_queue": sum(lane["max_queue"] for lane in lanes.values()),
+                "admitted": sum(lane["admitted"] for lane in lanes.values()),
+                "rejected": sum(lane["rejected"] for lane in lanes.values()),
+                "timed_out": sum(lane["timed_out"] for lane in lanes.values()),
+                "wait_ms_avg": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_ms_p99": _percentile_ms(waits, 0.99),
+                "scheduling": self.scheduling,
+                "lanes": lanes
+            }
+
+admission = AdmissionController(
+    MAX_INFLIGHT,
+    {lane: (LANE_QUEUES[lane], LANE_WEIGHTS.get(lane, 1)) for lane in LANES},
+    LANE_SCHEDULING
+)
+
+_metrics_publisher_pid = None
+
+def start_metrics_publisher():
+    """Publish this worker's admission metrics to CloudWatch, once per worker process"""
+    global _metrics_publisher_pid
+    if not METRICS_NAMESPACE or _metrics_publisher_pid == os.getpid():
+        return
+    _metrics_publisher_pid = os.getpid()
+
+    def publish():
+        cloudwatch = boto3.session.Session().client('cloudwatch')
+        dimensions = [{'Name': 'EndpointName', 'Value': ENDPOINT_NAME}]
+        while True:
+            time.sleep(METRICS_INTERVAL_S)
+            stats = admission.snapshot()
+            try:
+                cloudwatch.put_metric_data(Namespace=METRICS_NAMESPACE, MetricData=[
+                    {'MetricName': 'QueueDepth', 'Dimensions': dimensions, 'Value': stats['queue_depth'], 'Unit': 'Count'},
+                    {'MetricName': 'InflightRequests', 'Dimensions': dimensions, 'Value': stats['inflight'], 'Unit': 'Count'},
+                    {'MetricName': 'QueueWaitTime', 'Dimensions': dimensions, 'Value': stats['wait_ms_avg'], 'Unit': 'Milliseconds'},
+                    {'MetricName': 'RejectedRequests', 'Dimensions': dimensions, 'Value': stats['rejected'] + stats['timed_out'], 'Unit': 'Count'},
+                    {'MetricName': 'WorkerMemoryRSS', 'Dimensions': dimensions, 'Value': memory_stats()['rss_mb'], 'Unit': 'Megabytes'}
+                ] + [
+                    {'MetricName': 'LaneLatencyP99', 'Dimensions': dimensions + [{'Name': 'Lane', 'Value': lane}],
+                     'Value': lane_stats['latency_ms_p99'], 'Unit': 'Milliseconds'}
+                    for lane, lane_stats in stats['lanes'].items()
+                ])
+            except Exception as e:
+                logger.error(f"Error publishing metrics from {socket.gethostname()}: {e}")
+
+    threading.Thread(target=publish, daemon=True, name='metrics').start()
+
+def memory_stats():
+    """Current and peak resident memory of this worker process"""
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    return {
+        "rss_mb": round(rss_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+# S3 client tuning (overridable through the model's container environment).
+# The connection pool must cover every serving thread in a worker plus the
+# concurrent ranged GETs of a multipart download, otherwise requests queue on it.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '32'))
+S3_CONNECT_TIMEOUT = float(os.environ.get('S3_CONNECT_TIMEOUT', '2'))
+S3_READ_TIMEOUT = float(os.environ.get('S3_READ_TIMEOUT', '10'))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', '5'))
+S3_RETRY_MODE = os.environ.get('S3_RETRY_MODE', 'adaptive')
+S3_MULTIPART_THRESHOLD_MB = int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', '8'))
+S3_MULTIPART_CHUNKSIZE_MB = int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', '8'))
+S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', '8'))
+
+s3_config = Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    connect_timeout=S3_CONNECT_TIMEOUT,
+    read_timeout=S3_READ_TIMEOUT,
+    retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE},
+    tcp_keepalive=True
+)
+
+# Objects above the threshold are fetched as concurrent ranged GETs
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=S3_MAX_CONCURRENCY,
+    use_threads=True
+)
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Return the S3 client of the current worker process.
+
+    serve imports the app in each worker after forking, so every worker normally
+    creates its own client on first use. The process id check is a safeguard for
+    gunicorn --preload, where the module is imported in the master: connection pools
+    must not be shared across forked workers.
+    """
+    global _s3_client, _s3_client_pid
+    pid = os.getpid()
+    if _s3_client is None or _s3_client_pid != pid:
+        with _s3_client_lock:
+            if _s3_client is None or _s3_client_pid != pid:
+                # boto3 sessions are not thread-safe, clients created from them are
+                session = boto3.session.Session()
+                _s3_client = session.client('s3', config=s3_config)
+                _s3_client_pid = pid
+    return _s3_client
+
+class _LimitedBuffer(io.BytesIO):
+    """In-memory download target that aborts the transfer once the object exceeds a size limit"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, b):
+        # Ranged parts are written at their own offset, so this also catches the last part first
+        if self.tell() + len(b) > self.limit:
+            raise ImageTooLarge(f"Image exceeds the maximum size of {self.limit / (1024 * 1024):g} MB")
+        return super().write(b)
+
+def fetch_image_bytes(bucket, key, max_bytes=int(MAX_IMAGE_MB * 1024 * 1024)):
+    """Download an S3 object into memory using the pooled client and transfer config"""
+    buffer = _LimitedBuffer(max_bytes)
+    get_s3_client().download_fileobj(bucket, key, buffer, Config=s3_transfer_config)
+    return buffer.getvalue()
+
+# Images are decoded at detection resolution: JPEGs larger than DETECTION_MAX_SIDE are
+# decoded with libjpeg DCT scaling (1/2, 1/4 or 1/8) instead of at full size.
+# Faces smaller than FULLRES_MIN_FACE_PX at detection resolution are re-extracted from
+# the full-quality decode, since they would otherwise be upscaled for the embedding model.
+DETECTION_MAX_SIDE = int(os.environ.get('DETECTION_MAX_SIDE', '1024'))
+FULLRES_MIN_FACE_PX = int(os.environ.get('FULLRES_MIN_FACE_PX', '160'))
+
+# Detection inputs are padded up to a small fixed set of side lengths so RetinaFace and
+# oneDNN only ever see a few shapes, all of which are compiled during warm-up. Embedding
+# batches are padded to a power of two up to EMBED_MAX_BATCH (rounded down to a power of two).
+DETECTION_BUCKETS = sorted(int(v) for v in os.environ.get('DETECTION_BUCKETS', '640,1024').split(',') if v.strip())
+EMBED_MAX_BATCH = 1 << (max(1, int(os.environ.get('EMBED_MAX_BATCH', '16'))).bit_length() - 1)
+WARMUP = os.environ.get('WARMUP', '1') == '1'
+
+# Tiled detection ("tiled": true in a request, or TILED_DETECTION=1 for all of them) runs
+# RetinaFace in parallel on overlapping TILE_SIZE tiles of the full-resolution image, plus
+# once on the detection-resolution image for faces too large to fit in the overlap.
+# Boxes found more than once, e.g. along tile seams, are merged with non-maximum suppression.
+TILED_DETECTION = os.environ.get('TILED_DETECTION', '0') == '1'
+TILE_SIZE = int(os.environ.get('TILE_SIZE', str(DETECTION_BUCKETS[-1] if DETECTION_BUCKETS else DETECTION_MAX_SIDE)))
+TILE_OVERLAP = int(os.environ.get('TILE_OVERLAP', str(FULLRES_MIN_FACE_PX)))
+TILE_WORKERS = int(os.environ.get('TILE_WORKERS', str(os.cpu_count() or 1)))
+TILE_NMS_IOU = float(os.environ.get('TILE_NMS_IOU', '0.4'))
+
+# Recognition models that requests may select (model_name or models), loaded on demand.
+# Least recently used models are evicted once their estimated size exceeds the budget.
+DEFAULT_MODEL = os.environ.get('MODEL_NAME', 'Facenet512')
+MODELS = [name.strip() for name in os.environ.get('MODELS', f'{DEFAULT_MODEL},ArcFace,SFace').split(',') if name.strip()]
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get('MODEL_MEMORY_BUDGET_MB', '1024'))
+
+# Default face filters, overridable per request (max_faces, min_face_px, min_confidence,
+# rank_faces_by). They are applied to detected regions before alignment and embedding;
+# MAX_FACES 0 keeps every face.
+MAX_FACES = int(os.environ.get('MAX_FACES', '0'))
+MIN_FACE_PX = int(os.environ.get('MIN_FACE_PX', '0'))
+MIN_CONFIDENCE = float(os.environ.get('MIN_CONFIDENCE', '0'))
+RANK_FACES_BY = os.environ.get('RANK_FACES_BY', 'area')  # area or confidence
+
+_REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+class DecodedImage:
+    """An image decoded at detection resolution, with lazy access to the full resolution"""
+
+    def __init__(self, data, img, scale):
+        self.data = data  # encoded bytes, kept to re-decode at full quality
+        self.img = img
+        self.scale = scale  # original pixels per detection-resolution pixel
+        self._full = None
+        self._content_hash = None
+        self.cache_lookup = None  # (cache key, result) when looked up ahead by warm_embedding_cache
+
+    @property
+    def nbytes(self):
+        return self.img.nbytes + len(self.data)
+
+    @property
+    def content_hash(self):
+        """SHA-256 of the encoded bytes, which identifies the image in caches"""
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.data).hexdigest()
+        return self._content_hash
+
+    @property
+    def original_size(self):
+        """(width, height) of the image before it was scaled down for detection"""
+        return round(self.img.shape[1] * self.scale), round(self.img.shape[0] * self.scale)
+
+    def full_resolution(self):
+        if self.scale == 1:
+            return self.img
+        if self._full is None:
+            self._full = _decode_scaled(self.data, 1)
+        return self._full
+
+    @classmethod
+    def from_array(cls, img, max_side=DETECTION_MAX_SIDE):
+        """Wrap an already decoded BGR frame, scaled down for detection"""
+        small = _downscale(img, max_side)
+        image = cls(b'', small, max(img.shape[:2]) / max(small.shape[:2]))
+        image._full = img
+        return image
+
+def _downscale(img, max_side):
+    """Resize img so its longest side is at most max_side (0 keeps it as is)"""
+    longest = max(img.shape[:2])
+    if max_side <= 0 or longest <= max_side:
+        return img
+    ratio = max_side / longest
+    return cv2.resize(
+        img,
+        (max(1, round(img.shape[1] * ratio)), max(1, round(img.shape[0] * ratio))),
+        interpolation=cv2.INTER_AREA
+    )
+
+def _read_header(data):
+    """Return (width, height, format, exif orientation) without decoding pixels"""
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            return header.size[0], header.size[1], header.format, header.getexif().get(0x0112, 1)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    except Exception:
+        return None
+
+def _decode_scaled(data, factor, use_turbojpeg=False):
+    if use_turbojpeg:
+        return _turbojpeg.decode(data, pixel_format=TJPF_BGR, scaling_factor=(1, factor))
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _REDUCED_DECODE_FLAGS[factor])
+    if img is None:
+        raise ValueError("Unable to decode image")
+    return img
+
+def decode_image(data, max_side=DETECTION_MAX_SIDE, max_pixels=MAX_IMAGE_PIXELS):
+    """Decode encoded image bytes to a BGR DecodedImage no larger than max_side"""
+    header = _read_header(data)
+    if header is not None and header[0] * header[1] > max_pixels:
+        raise ImageTooLarge(f"Image has {header[0] * header[1]} pixels, the maximum is {max_pixels}")
+    factor = 1
+    use_turbojpeg = False
+    if header is not None and max_side > 0:
+        width, height, image_format, orientation = header
+        for n in (8, 4, 2):
+            if max(width, height) / n >= max_side:
+                factor = n
+                break
+        # libjpeg-turbo does not apply EXIF rotation, OpenCV does
+        use_turbojpeg = _turbojpeg is not None and image_format == 'JPEG' and orientation == 1
+
+    img = _decode_scaled(data, factor, use_turbojpeg)
+    original_longest = max(header[:2]) if header is not None else max(img.shape[:2]) * factor
+    img = _downscale(img, max_side)
+    return DecodedImage(data, img, original_longest / max(img.shape[:2]))
+
+def _map_facial_area(area, scale=1, offset_x=0, offset_y=0):
+    """Map a facial area from a scaled or cropped image back to original image coordinates"""
+    def point(p):
+        return None if p is None else (int(p[0] * scale) + offset_x, int(p[1] * scale) + offset_y)
+    return {
+        "x": int(area["x"] * scale) + offset_x,
+        "y": int(area["y"] * scale) + offset_y,
+        "w": int(area["w"] * scale),
+        "h": int(area["h"] * scale),
+        "left_eye": point(area.get("left_eye")),
+        "right_eye": point(area.get("right_eye"))
+    }
+
+def _pad_to_bucket(img):
+    """Pad img at the bottom and right so each side is the smallest bucket that fits it"""
+    def fit(n):
+        return next((bucket for bucket in DETECTION_BUCKETS if bucket >= n), n)
+    height, width = img.shape[:2]
+    bottom, right = fit(height) - height, fit(width) - width
+    if bottom == 0 and right == 0:
+        return img
+    # Padding the far edges leaves the coordinates of detected faces unchanged
+    return cv2.copyMakeBorder(img, 0, bottom, 0, right, cv2.BORDER_CONSTANT, value=[0, 0, 0])
+
+NO_FACE_MESSAGE = (
+    "Face could not be detected. Please confirm that the picture is a face photo "
+    "or consider to set enforce_detection param to False."
+)
+
+def _detect_regions(img):
+    """Run RetinaFace on img inside the black border DeepFace adds before detection.
+
+    Returns the bordered image, the border widths and the regions in bordered coordinates.
+    """
+    height, width = img.shape[:2]
+    # Same black border as DeepFace, so alignment does not rotate faces out of the image
+    height_border, width_border = int(0.5 * height), int(0.5 * width)
+    bordered = cv2.copyMakeBorder(
+        img, height_border, height_border, width_border, width_border,
+        cv2.BORDER_CONSTANT, value=[0, 0, 0]
+    )
+    regions = modeling.build_model(task="face_detector", model_name="retinaface").detect_faces(bordered)
+    return bordered, width_border, height_border, regions
+
+def _run_detector(img, enforce_detection=True, face_filter=None):
+    """Detect and align the faces of img like DeepFace.extract_faces with retinaface.
+
+    face_filter is applied to the detected regions before any of them is aligned, so
+    faces that are dropped never pay for the rotation and crop.
+    """
+    img = _pad_to_bucket(img)
+    height, width = img.shape[:2]
+    bordered, width_border, height_border, regions = _detect_regions(img)
+    if not regions and enforce_detection:
+        raise ValueError(NO_FACE_MESSAGE)
+    # Faces that were detected but filtered out give an empty result, not an error
+    if face_filter is not None:
+        regions = face_filter(regions)
+
+    faces = []
+    for region in regions:
+        aligned, angle = detection.align_img_wrt_eyes(
+            img=bordered, left_eye=region.left_eye, right_eye=region.right_eye
+        )
+        x1, y1, x2, y2 = detection.project_facial_area(
+            facial_area=(region.x, region.y, region.x + region.w, region.y + region.h),
+            angle=angle,
+            size=(bordered.shape[0], bordered.shape[1])
+        )
+        face = aligned[int(y1):int(y2), int(x1):int(x2)]
+        if face.shape[0] == 0 or face.shape[1] == 0:
+            continue
+        x = max(0, int(region.x - width_border))
+        y = max(0, int(region.y - height_border))
+        faces.append({
+            "face": face[:, :, ::-1] / 255,
+            "facial_area": {
+                "x": x,
+                "y": y,
+                "w": min(width - x - 1, int(region.w)),
+                "h": min(height - y - 1, int(region.h)),
+                "left_eye": _shift_point(region.left_eye, width_border, height_border),
+                "right_eye": _shift_point(region.right_eye, width_border, height_border)
+            },
+            "confidence": round(region.confidence or 0, 2)
+        })
+    return faces
+
+def _shift_point(point, dx, dy):
+    return None if point is None else (point[0] - dx, point[1] - dy)
+
+def select_faces(regions, scale=1, max_faces=0, min_face_px=0, min_confidence=0.0, rank_by='area'):
+    """Drop detected regions that are too small or too uncertain and keep the top max_faces.
+
+    Regions are in detection coordinates, min_face_px is in original image pixels.
+    """
+    regions = [
+        region for region in regions
+        if min(region.w, region.h) * scale >= min_face_px and (region.confidence or 0) >= min_confidence
+    ]
+    if max_faces and len(regions) > max_faces:
+        if rank_by == 'confidence':
+            regions = sorted(regions, key=lambda region: region.confidence or 0, reverse=True)
+        else:
+            regions = sorted(regions, key=lambda region: region.w * region.h, reverse=True)
+        regions = regions[:max_faces]
+    return regions
+
+def _refine_face(image, face):
+    """Re-extract a face from the full-resolution image around its detected area.
+
+    The area and eyes found at detection resolution, scaled to the original image, are
+    enough to align a window of the full-quality decode, so detection does not run again.
+    """
+    region = FacialAreaRegion(confidence=face["confidence"], **face["facial_area"])
+    aligned = _align_region(image.full_resolution(), region)
+    if aligned.shape[0] == 0 or aligned.shape[1] == 0:
+        return face
+    return {**face, "face": aligned[:, :, ::-1] / 255}
+
+_tile_executor = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix='tile')
+
+def _tile_origins(length, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Offsets of the tiles covering length, each pair of neighbours sharing overlap pixels"""
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, tile - overlap)) + [length - tile]
+
+def _detect_tile(img, offset_x=0, offset_y=0, scale=1):
+    """Detect the face regions of img, mapped to original image coordinates.
+
+    Unlike _detect_regions this adds no border: faces are aligned later on the full image,
+    and a border would halve the resolution the detector sees the tile at.
+    """
+    regions = modeling.build_model(task="face_detector", model_name="retinaface").detect_faces(_pad_to_bucket(img))
+    mapped = []
+    for region in regions:
+        area = _map_facial_area({
+            "x": region.x,
+            "y": region.y,
+            "w": region.w,
+            "h": region.h,
+            "left_eye": region.left_eye,
+            "right_eye": region.right_eye
+        }, scale, offset_x, offset_y)
+        mapped.append(FacialAreaRegion(confidence=region.confidence or 0, **area))
+    return mapped
+
+def _intersection_ratios(a, b):
+    """(IoU, intersection over the smaller area) of two regions"""
+    x1, y1 = max(a.x, b.x), max(a.y, b.y)
+    x2, y2 = min(a.x + a.w, b.x + b.w), min(a.y + a.h, b.y + b.h)
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    smaller = min(a.w * a.h, b.w * b.h)
+    union = a.w * a.h + b.w * b.h - intersection
+    return (intersection / union if union > 0 else 0.0), (intersection / smaller if smaller > 0 else 0.0)
+
+def non_max_suppression(regions, iou_threshold=TILE_NMS_IOU, containment_threshold=0.8):
+    """Keep the best of every group of overlapping regions, ranked by confidence * area.
+
+    A region mostly inside a better one is dropped as well: it is usually the part of a
+    face that was cut by a tile edge.
+    """
+    kept = []
+    for region in sorted(regions, key=lambda r: r.confidence * r.w * r.h, reverse=True):
+        overlaps = (_intersection_ratios(region, other) for other in kept)
+        if all(iou < iou_threshold and contained < containment_threshold for iou, contained in overlaps):
+            kept.append(region)
+    return kept
+
+def _align_region(img, region):
+    """Crop and align one face of img, rotating only a window around it.
+
+    The window is padded with black where it leaves the image, like DeepFace's border.
+    """
+    margin = max(region.w, region.h)
+    x1, y1 = region.x - margin, region.y - margin
+    x2, y2 = region.x + region.w + margin, region.y + region.h + margin
+    height, width = img.shape[:2]
+    window = cv2.copyMakeBorder(
+        img[max(0, y1):y2, max(0, x1):x2],
+        max(0, -y1), max(0, y2 - height), max(0, -x1), max(0, x2 - width),
+        cv2.BORDER_CONSTANT, value=[0, 0, 0]
+    )
+    aligned, angle = detection.align_img_wrt_eyes(
+        img=window,
+        left_eye=_shift_point(region.left_eye, x1, y1),
+        right_eye=_shift_point(region.right_eye, x1, y1)
+    )
+    fx1, fy1, fx2, fy2 = detection.project_facial_area(
+        facial_area=(margin, margin, margin + region.w, margin + region.h),
+        angle=angle,
+        size=(window.shape[0], window.shape[1])
+    )
+    return aligned[int(fy1):int(fy2), int(fx1):int(fx2)]
+
+def detect_faces_tiled(image, enforce_detection=True, face_filters=None):
+    """Detect faces on overlapping full-resolution tiles in parallel, in original image coordinates"""
+    full = image.full_resolution()
+    height, width = full.shape[:2]
+    jobs = [_tile_executor.submit(_detect_tile, image.img, scale=image.scale)]
+    for y in _tile_origins(height):
+        for x in _tile_origins(width):
+            jobs.append(_tile_executor.submit(_detect_tile, full[y:y + TILE_SIZE, x:x + TILE_SIZE], x, y))
+    regions = non_max_suppression([region for job in jobs for region in job.result()])
+    if not regions and enforce_detection:
+        raise ValueError(NO_FACE_MESSAGE)
+    if face_filters:
+        regions = select_faces(regions, **face_filters)
+
+    faces = []
+    for region in regions:
+        face = _align_region(full, region)
+        if face.shape[0] == 0 or face.shape[1] == 0:
+            continue
+        x, y = max(0, region.x), max(0, region.y)
+        faces.append({
+            "face": face[:, :, ::-1] / 255,
+            "facial_area": {
+                "x": x,
+                "y": y,
+                "w": min(width - x - 1, region.w),
+                "h": min(height - y - 1, region.h),
+                "left_eye": region.left_eye,
+                "right_eye": region.right_eye
+            },
+            "confidence": round(region.confidence, 2)
+        })
+    return faces
+
+def detect_faces(image, enforce_detection=True, face_filters=None, tiled=False):
+    """Detect and align the faces of a DecodedImage, in original image coordinates.
+
+    face_filters are select_faces keyword arguments (max_faces, min_face_px, ...).
+    Tiled detection only applies to images larger than one tile.
+    """
+    if tiled and max(image.original_size) > TILE_SIZE:
+        return detect_faces_tiled(image, enforce_detection, face_filters)
+    face_filter = partial(select_faces, scale=image.scale, **face_filters) if face_filters else None
+    faces = _run_detector(image.img, enforce_detection, face_filter)
+    for i, face in enumerate(faces):
+        small = min(face["facial_area"]["w"], face["facial_area"]["h"]) < FULLRES_MIN_FACE_PX
+        face["facial_area"] = _map_facial_area(face["facial_area"], image.scale)
+        if image.scale > 1 and small:
+            faces[i] = _refine_face(image, face)
+    return faces
+
+class EmbeddingModel:
+    """A DeepFace recognition model that embeds a batch of preprocessed faces.
+
+    In low-memory mode a Keras model is converted to TFLite with int8 dynamic-range (or
+    float16) weights and the float32 Keras graph is released. The reduced model is only kept
+    if its embeddings of a probe batch stay within LOW_MEMORY_MIN_COSINE of the
+    original ones, so accuracy-sensitive models silently keep full precision.
+    """
+
+    def __init__(self, model_name, weights=None):
+        self.model_name = model_name
+        rss_before = memory_stats()['rss_mb']
+        self.client = modeling.build_model(task="facial_recognition", model_name=model_name)
+        self.input_shape = self.client.input_shape
+        self.interpreter = None
+        self._lock = threading.Lock()  # TFLite interpreters are not thread-safe
+        self.weights = 'float32'
+        self.params = self.client.model.count_params() if self._is_keras() else 0
+        if weights:
+            self._reduce_precision(weights)
+        self.size_mb = self._estimate_size_mb(rss_before)
+
+    def _estimate_size_mb(self, rss_before):
+        if self.params:
+            # The CPU interpreter dequantizes float16 weights to float32 when it loads them
+            bytes_per_param = {'float32': 4, 'float16': 4, 'int8': 1}[self.weights]
+            return self.params * bytes_per_param / (1024 * 1024)
+        # Models outside TensorFlow: fall back to what loading added to the worker's RSS
+        return max(1.0, memory_stats()['rss_mb'] - rss_before)
+
+    def _is_keras(self):
+        # SFace and Dlib run outside TensorFlow and only expose forward()
+        return hasattr(self.client.model, 'layers')
+
+    def _reduce_precision(self, weights):
+        import tensorflow as tf
+        if not self._is_keras():
+            return
+        keras_model = self.client.model
+        converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if weights == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        interpreter = tf.lite.Interpreter(model_content=converter.convert())
+        interpreter.allocate_tensors()
+
+        probe = np.random.default_rng(0).random((4, self.input_shape[1], self.input_shape[0], 3), dtype=np.float32)
+        expected = keras_model(probe, training=False).numpy()
+        actual = self._invoke(interpreter, probe)
+        similarity = float(np.min(
+            np.sum(expected * actual, axis=1)
+            / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+        ))
+        if similarity < LOW_MEMORY_MIN_COSINE:
+            logger.error(f"Keeping float32 {self.model_name}: {weights} weights reached cosine similarity {similarity:.4f}")
+            return
+
+        print(f'{self.model_name} running with {weights} weights (cosine similarity {similarity:.4f})')
+        self.interpreter = interpreter
+        self.weights = weights
+        self.client.model = None  # release the float32 Keras graph
+        gc.collect()
+
+    @staticmethod
+    def _invoke(interpreter, batch):
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        outputs = []
+        for img in batch:
+            interpreter.set_tensor(input_index, img[np.newaxis].astype(np.float32))
+            interpreter.invoke()
+            outputs.append(interpreter.get_tensor(output_index)[0].copy())
+        return np.stack(outputs)
+
+    def predict(self, batch):
+        """Return one embedding row per preprocessed face in batch"""
+        if self.interpreter is not None:
+            with self._lock:
+                return self._invoke(self.interpreter, batch)
+        if not self._is_keras():
+            return np.array([self.client.forward(img[np.newaxis]) for img in batch])
+
+        outputs = []
+        for start in range(0, len(batch), EMBED_MAX_BATCH):
+            chunk = batch[start:start + EMBED_MAX_BATCH]
+            count = len(chunk)
+            padded = 1 << (count - 1).bit_length()
+            if padded > count:
+                chunk = np.concatenate([chunk, np.zeros((padded - count,) + chunk.shape[1:], dtype=chunk.dtype)])
+            outputs.append(self.client.model(chunk, training=False).numpy()[:count])
+        return np.concatenate(outputs)
+
+_embedding_models = OrderedDict()  # least recently used first
+_embedding_models_lock = threading.Lock()  # guards _embedding_models, never held while loading
+_embedding_model_loads = {}  # model name -> lock held while that model loads
+
+def _cached_embedding_model(model_name):
+    with _embedding_models_lock:
+        model = _embedding_models.get(model_name)
+        if model is not None:
+            _embedding_models.move_to_end(model_name)
+        return model
+
+def get_embedding_model(model_name=DEFAULT_MODEL):
+    """Return the worker's EmbeddingModel for model_name, loading it on first use.
+
+    Only requests for the model being loaded wait for it; the others keep running.
+    """
+    if model_name not in MODELS:
+        raise BadRequest(f"Unsupported model {model_name}, available models: {', '.join(MODELS)}")
+    model = _cached_embedding_model(model_name)
+    if model is not None:
+        return model
+    with _embedding_models_lock:
+        load_lock = _embedding_model_loads.setdefault(model_name, threading.Lock())
+    with load_lock:
+        # Another request may have loaded it while this one waited
+        model = _cached_embedding_model(model_name)
+        if model is not None:
+            return model
+        print(f'Loading model {model_name}')
+        model = EmbeddingModel(model_name, LOW_MEMORY_WEIGHTS if LOW_MEMORY else None)
+        with _embedding_models_lock:
+            _embedding_models[model_name] = model
+            _evict_embedding_models(keep=model_name)
+        return model
+
+def _evict_embedding_models(keep):
+    evicted = False
+    while len(_embedding_models) > 1 and sum(m.size_mb for m in _embedding_models.values()) > MODEL_MEMORY_BUDGET_MB:
+        name = next(name for name in _embedding_models if name != keep)
+        model = _embedding_models.pop(name)
+        # DeepFace keeps its own singleton of every model it has built
+        getattr(modeling, 'cached_models', {}).get("facial_recognition", {}).pop(name, None)
+        print(f'Evicted model {name} ({model.size_mb:.0f} MB)')
+        evicted = True
+    if evicted:
+        gc.collect()
+
+def embed_faces(faces, model_name=DEFAULT_MODEL):
+    """Embed aligned faces the same way DeepFace.represent does after detection, as one batch"""
+    if not faces:
+        return []
+    model = get_embedding_model(model_name)
+    target_size = model.input_shape
+    batch = []
+    for face in faces:
+        img = face["face"][:, :, ::-1]  # rgb to bgr
+        img = preprocessing.resize_image(img=img, target_size=(target_size[1], target_size[0]))
+        batch.append(preprocessing.normalize_input(img=img, normalization="base"))
+    return [embedding.tolist() for embedding in model.predict(np.concatenate(batch))]
+
+def warm_up():
+    """Run every detection bucket and embedding batch size once before serving"""
+    start = time.time()
+    for height in DETECTION_BUCKETS:
+        for width in DETECTION_BUCKETS:
+            _run_detector(np.zeros((height, width, 3), dtype=np.uint8), enforce_detection=False)
+    model = get_embedding_model()
+    size = 1
+    while size <= EMBED_MAX_BATCH:
+        model.predict(np.zeros((size, model.input_shape[1], model.input_shape[0], 3), dtype=np.float32))
+        size *= 2
+    print(f'Warm-up finished in {time.time() - start:.1f}s')
+
+def _represent_faces(image, deadline=None, model_name=DEFAULT_MODEL, models=None, face_filters=None, tiled=False):
+    """Detect faces in a DecodedImage once and embed them with one or several models.
+
+    With a single model_name the result has the DeepFace.represent format. With a list
+    of models every face carries an "embeddings" dict keyed by model name instead.
+    """
+    return _embed_and_format(detect_faces(image, face_filters=face_filters, tiled=tiled), deadline, model_name, models)
+
+def _embed_and_format(faces, deadline=None, model_name=DEFAULT_MODEL, models=None):
+    embeddings = {}
+    for name in (models or [model_name]):
+        if deadline is not None:
+            deadline.check(f"embedding with {name}")
+        embeddings[name] = embed_faces(faces, name)
+
+    if not models:
+        return [
+            {
+                "embedding": embedding,
+                "facial_area": face["facial_area"],
+                "face_confidence": face["confidence"]
+            }
+            for face, embedding in zip(faces, embeddings[model_name])
+        ]
+    return [
+        {
+            "embeddings": {name: embeddings[name][i] for name in models},
+            "facial_area": face["facial_area"],
+            "face_confidence": face["confidence"]
+        }
+        for i, face in enumerate(faces)
+    ]
+
+# Video and animated image ingestion. Frames are decoded one at a time and sampled at
+# VIDEO_SAMPLE_FPS ("fps" sampling) or only when the scene changes ("scene" sampling).
+# Faces are tracked across sampled frames by box overlap and each track is embedded
+# once, on its best frame, when it ends.
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.webm', '.avi', '.mkv')
+VIDEO_SAMPLE_FPS = float(os.environ.get('VIDEO_SAMPLE_FPS', '2'))
+VIDEO_SCENE_THRESHOLD = float(os.environ.get('VIDEO_SCENE_THRESHOLD', '0.3'))
+VIDEO_MAX_FRAMES = int(os.environ.get('VIDEO_MAX_FRAMES', '600'))
+VIDEO_TRACK_IOU = float(os.environ.get('VIDEO_TRACK_IOU', '0.3'))
+VIDEO_TRACK_MAX_MISSED = int(os.environ.get('VIDEO_TRACK_MAX_MISSED', '2'))
+MAX_VIDEO_MB = float(os.environ.get('MAX_VIDEO_MB', '500'))
+
+def media_type(key):
+    """Guess whether an S3 key holds a still image, an animated image or a video"""
+    lowered = key.lower()
+    if lowered.endswith('.gif'):
+        return 'animation'
+    if lowered.endswith(VIDEO_EXTENSIONS):
+        return 'video'
+    return 'image'
+
+class MediaSource:
+    """A video or animated image from S3 that yields sampled (timestamp, BGR frame) pairs"""
+
+    def __init__(self, bucket, key, media):
+        self.media = media
+        self.data = None
+        self.file_path = None
+        if media == 'animation':
+            self.data = fetch_image_bytes(bucket, key)
+            return
+
+        size = get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+        if size > MAX_VIDEO_MB * 1024 * 1024:
+            raise ImageTooLarge(f"Video exceeds the maximum size of {MAX_VIDEO_MB:g} MB")
+        # OpenCV reads videos from disk. Generate a secure random filename instead of using the S3 key
+        temp_dir = tempfile.gettempdir()
+        file_path = os.path.normpath(os.path.join(temp_dir, str(uuid4())))
+        if not file_path.startswith(temp_dir):
+            raise Exception("Invalid file path: Potential directory traversal detected.")
+        self.file_path = file_path
+        try:
+            get_s3_client().download_file(bucket, key, file_path, Config=s3_transfer_config)
+        except Exception:
+            self.close()
+            raise
+
+    def frames(self, sample_fps):
+        """Yield (timestamp, BGR frame) pairs sampled at sample_fps"""
+        if not sample_fps > 0:
+            raise ValueError(f"sample_fps must be greater than 0, got {sample_fps}")
+        interval = 1 / sample_fps
+        samples = 0  # sample times n * interval already taken or skipped
+
+        def wanted(timestamp):
+            nonlocal samples
+            # Frame timestamps are sums of float durations, so compare with some slack
+            timestamp += 1e-6
+            if timestamp < samples * interval:
+                return False
+            while samples * interval <= timestamp:
+                samples += 1
+            return True
+
+        if self.media == 'animation':
+            return self._animation_frames(wanted)
+        return self._video_frames(wanted)
+
+    def _animation_frames(self, wanted):
+        with Image.open(io.BytesIO(self.data)) as animation:
+            timestamp = 0.0
+            for frame in ImageSequence.Iterator(animation):
+                if wanted(timestamp):
+                    yield timestamp, cv2.cvtColor(np.asarray(frame.convert('RGB')), cv2.COLOR_RGB2BGR)
+                timestamp += frame.info.get('duration', 100) / 1000
+
+    def _video_frames(self, wanted):
+        capture = cv2.VideoCapture(self.file_path)
+        if not capture.isOpened():
+            raise ValueError("Unable to decode video")
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        try:
+            index = 0
+            while True:
+                timestamp = index / fps
+                if wanted(timestamp):
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield timestamp, frame
+                elif not capture.grab():  # skipped frames are not converted to BGR
+                    break
+                index += 1
+        finally:
+            capture.release()
+
+    def close(self):
+        if self.file_path is not None and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+def scene_changes(frames, threshold=VIDEO_SCENE_THRESHOLD):
+    """Keep only the frames whose colour histogram differs from the last kept frame"""
+    previous = None
+    for timestamp, frame in frames:
+        hsv = cv2.cvtColor(cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2HSV)
+        histogram = cv2.normalize(cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256]), None)
+        if previous is None or cv2.compareHist(previous, histogram, cv2.HISTCMP_BHATTACHARYYA) > threshold:
+            previous = histogram
+            yield timestamp, frame
+
+def _iou(a, b):
+    x1, y1 = max(a["x"], b["x"]), max(a["y"], b["y"])
+    x2, y2 = min(a["x"] + a["w"], b["x"] + b["w"]), min(a["y"] + a["h"], b["y"] + b["h"])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a["w"] * a["h"] + b["w"] * b["h"] - intersection
+    return intersection / union if union > 0 else 0.0
+
+class FaceTracker:
+    """Greedy IoU tracker that keeps the best-quality face of every track"""
+
+    def __init__(self, min_iou=VIDEO_TRACK_IOU, max_missed=VIDEO_TRACK_MAX_MISSED):
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 0
+
+    @staticmethod
+    def _quality(face):
+        return face["confidence"] * face["facial_area"]["w"] * face["facial_area"]["h"]
+
+    def update(self, timestamp, faces):
+        """Add the faces of a sampled frame and return the tracks that ended"""
+        pairs = sorted(
+            (
+                (_iou(track["facial_area"], face["facial_area"]), t, f)
+                for t, track in enumerate(self.tracks)
+                for f, face in enumerate(faces)
+            ),
+            key=lambda pair: pair[0],
+            reverse=True
+        )
+        matched_tracks, matched_faces = set(), set()
+        for iou, t, f in pairs:
+            if iou < self.min_iou:
+                break
+            if t in matched_tracks or f in matched_faces:
+                continue
+            matched_tracks.add(t)
+            matched_faces.add(f)
+            track, face = self.tracks[t], faces[f]
+            track.update(facial_area=face["facial_area"], end_time=timestamp, missed=0, frames=track["frames"] + 1)
+            if self._quality(face) > self._quality(track["best"]):
+                track.update(best=face, best_frame_time=timestamp)
+
+        finished, active = [], []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track["missed"] += 1
+            (finished if track["missed"] > self.max_missed else active).append(track)
+        for f, face in enumerate(faces):
+            if f not in matched_faces:
+                active.append({
+                    "track_id": self.next_id,
+                    "facial_area": face["facial_area"],
+                    "start_time": timestamp,
+                    "end_time": timestamp,
+                    "frames": 1,
+                    "missed": 0,
+                    "best": face,
+                    "best_frame_time": timestamp
+                })
+                self.next_id += 1
+        self.tracks = active
+        return finished
+
+    def finish(self):
+        finished, self.tracks = self.tracks, []
+        return finished
+
+def _embed_tracks(tracks, deadline, model_name, models):
+    if not tracks:
+        return
+    results = _embed_and_format([track["best"] for track in tracks], deadline, model_name, models)
+    for track, result in zip(tracks, results):
+        yield {
+            "track_id": track["track_id"],
+            "start_time": round(track["start_time"], 3),
+            "end_time": round(track["end_time"], 3),
+            "frames": track["frames"],
+            "best_frame_time": round(track["best_frame_time"], 3),
+            **result
+        }
+
+def analyse_media(source, deadline, slot, sampling='fps', sample_fps=VIDEO_SAMPLE_FPS, model_name=DEFAULT_MODEL,
+                  models=None, face_filters=None, tiled=False):
+    """Yield one record per face track of a MediaSource, as soon as the track ends.
+
+    The first frame runs in slot, the request's inference slot. The slot is given back
+    after each frame and taken again for the next, so a long video lets other requests
+    run between its frames.
+    """
+    frames = source.frames(sample_fps)
+    if sampling == 'scene':
+        frames = scene_changes(frames)
+    tracker = FaceTracker()
+    for count, (timestamp, frame) in enumerate(frames):
+        if count >= VIDEO_MAX_FRAMES:
+            break
+        deadline.check(f"frame at {timestamp:.2f}s")
+        slot = slot.renew(deadline)
+        try:
+            faces = detect_faces(DecodedImage.from_array(frame), enforce_detection=False, face_filters=face_filters, tiled=tiled)
+            records = list(_embed_tracks(tracker.update(timestamp, faces), deadline, model_name, models))
+        finally:
+            slot.release()
+        yield from records
+    slot = slot.renew(deadline)
+    try:
+        records = list(_embed_tracks(tracker.finish(), deadline, model_name, models))
+    finally:
+        slot.release()
+    yield from records
+
+# Streaming responses. Clients that send Accept: application/x-ndjson (or "stream": "ndjson")
+# get one JSON line per face as soon as its image is embedded; Accept:
+# application/x-embedding-records (or "stream": "binary") gets length-prefixed binary records.
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'binary': 'application/x-embedding-records'
+}
+
+def negotiate_stream_format(data):
+    """Return the streaming format a request asked for, or None for a single JSON document"""
+    requested = data.get('stream')
+    if requested is True:
+        return 'ndjson'
+    if requested in STREAM_MIMETYPES:
+        return requested
+    # Only an explicit Accept entry counts, */* keeps the JSON response
+    accepted = set(request.accept_mimetypes.values())
+    return next((fmt for fmt, mimetype in STREAM_MIMETYPES.items() if mimetype in accepted), None)
+
+def encode_ndjson_record(record):
+    return (json.dumps(record) + '\n').encode()
+
+def encode_binary_record(record):
+    """Encode a record as: uint32 record length, uint32 header length, JSON header, float32 vectors.
+
+    The header holds every field except the embeddings, plus a "vectors" list of
+    {"model", "dims"} describing the little-endian float32 vectors that follow it.
+    """
+    header = {k: v for k, v in record.items() if k not in ('embedding', 'embeddings')}
+    vectors = []
+    if 'embedding' in record:
+        vectors.append((None, record['embedding']))
+    vectors.extend(record.get('embeddings', {}).items())
+    header['vectors'] = [{"model": name, "dims": len(vector)} for name, vector in vectors]
+    header_bytes = json.dumps(header).encode()
+    body = struct.pack('>I', len(header_bytes)) + header_bytes + b''.join(
+        np.asarray(vector, dtype='<f4').tobytes() for _, vector in vectors
+    )
+    return struct.pack('>I', len(body)) + body
+
+def decode_binary_record(data, offset=0):
+    """Decode the encode_binary_record record at offset, returning it and the next offset"""
+    length, header_length = struct.unpack_from('>II', data, offset)
+    start = offset + 8
+    header = json.loads(data[start:start + header_length])
+    position = start + header_length
+    vectors = {}
+    for vector in header.pop('vectors'):
+        end = position + 4 * vector["dims"]
+        vectors[vector["model"]] = np.frombuffer(data[position:end], dtype='<f4').tolist()
+        position = end
+    record = {}
+    if None in vectors:
+        record["embedding"] = vectors[None]
+    elif vectors:
+        record["embeddings"] = vectors
+    record.update(header)
+    return record, offset + 4 + length
+
+def streaming_response(records, stream_format, on_close=()):
+    """Stream records in the requested format, ending with an error record on failure.
+
+    on_close callbacks run once the response is closed, which is when the records have
+    been sent or the client went away, so resources such as the media source and an
+    inference slot still held by the stream live as long as the stream.
+    """
+    encode = encode_binary_record if stream_format == 'binary' else encode_ndjson_record
+
+    def generate():
+        try:
+            for record in records:
+                yield encode(record)
+        except Exception as e:
+            logger.error(f"Error while streaming results: {e}", exc_info=not isinstance(e, RequestRejected))
+            yield encode({"error_type": type(e).__name__, "error_message": str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
+    for callback in on_close:
+        response.call_on_close(callback)
+    return response
+
+def stream_image_records(images, deadline, slot, model_name=DEFAULT_MODEL, models=None, face_filters=None, tiled=False):
+    """Yield one record per face of each (key, image, error), as soon as that image is embedded.
+
+    The first image runs in slot, the request's inference slot; later images queue for a
+    slot of their own, so freed slots can go to other lanes between images.
+    """
+    for key, image, error in images:
+        if error is None:
+            deadline.check(f"analysing {key}")
+            slot = slot.renew(deadline)
+            try:
+                print(f'analysing: {key}')
+                faces = represent_image(image, deadline, model_name, models, face_filters, tiled)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                slot.release()
+        if error is not None:
+            logger.error(f"Error processing image {key}: {error}")
+            yield {"key": key, "error_type": type(error).__name__, "error_message": str(error)}
+            continue
+        for index, face in enumerate(faces):
+            yield {"key": key, "face_index": index, **face}
+
+# Near-duplicate short-circuit: images whose perceptual hash is within PHASH_MAX_DISTANCE
+# bits of a recently embedded image (same models, same aspect ratio) reuse its result.
+# In audit mode matches are still recomputed and compared, to tune the threshold.
+PHASH_ENABLED = os.environ.get('PHASH_ENABLED', '0') == '1'
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', '6'))
+PHASH_INDEX_SIZE = int(os.environ.get('PHASH_INDEX_SIZE', '10000'))
+PHASH_AUDIT = os.environ.get('PHASH_AUDIT', '0') == '1'
+PHASH_AUDIT_MIN_COSINE = float(os.environ.get('PHASH_AUDIT_MIN_COSINE', '0.9'))
+
+def perceptual_hash(img):
+    """64-bit DCT perceptual hash (pHash) of a BGR image"""
+    thumbnail = cv2.cvtColor(cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    low_frequencies = cv2.dct(np.float32(thumbnail))[:8, :8]
+    bits = (low_frequencies > np.median(low_frequencies)).flatten()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+def _first_embedding(face):
+    return face["embedding"] if "embedding" in face else next(iter(face["embeddings"].values()))
+
+def _results_agree(cached, fresh, min_cosine):
+    """True if every freshly computed face has a matching embedding in the cached result"""
+    if len(cached) != len(fresh) or not cached:
+        return len(cached) == len(fresh)
+    cached_embeddings = np.array([_first_embedding(face) for face in cached])
+    cached_embeddings /= np.linalg.norm(cached_embeddings, axis=1, keepdims=True)
+    for face in fresh:
+        embedding = np.array(_first_embedding(face))
+        if np.max(cached_embeddings @ (embedding / np.linalg.norm(embedding))) < min_cosine:
+            return False
+    return True
+
+def _rescale_result(result, from_size, to_size):
+    """Copy a result with its facial areas moved from one image size to another"""
+    scale_x, scale_y = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    def point(p):
+        return None if p is None else (int(p[0] * scale_x), int(p[1] * scale_y))
+    rescaled = []
+    for face in result:
+        area = face["facial_area"]
+        face = dict(face)
+        face["facial_area"] = {
+            "x": int(area["x"] * scale_x),
+            "y": int(area["y"] * scale_y),
+            "w": int(area["w"] * scale_x),
+            "h": int(area["h"] * scale_y),
+            "left_eye": point(area.get("left_eye")),
+            "right_eye": point(area.get("right_eye"))
+        }
+        rescaled.append(face)
+    return rescaled
+
+class PerceptualHashIndex:
+    """Ring buffer of the perceptual hashes of recently embedded images and their results"""
+
+    def __init__(self, size, max_distance, max_aspect_difference=0.02):
+        self.max_distance = max_distance
+        self.max_aspect_difference = max_aspect_difference
+        self.hashes = np.zeros(max(1, size), dtype=np.uint64)
+        self.entries = [None] * len(self.hashes)
+        self.count = 0
+        self.next = 0
+        self.lookups = 0
+        self.hits = 0
+        self.audited = 0
+        self.false_matches = 0
+        self.hit_distances = [0] * (max_distance + 1)
+        self.false_match_distances = [0] * (max_distance + 1)
+        self._lock = threading.Lock()
+
+    def lookup(self, phash, size, key):
+        """Return (rescaled result, distance) of the closest compatible entry, or None"""
+        with self._lock:
+            self.lookups += 1
+            distances = np.bitwise_count(self.hashes[:self.count] ^ phash)
+            candidates = np.nonzero(distances <= self.max_distance)[0]
+            for i in candidates[np.argsort(distances[candidates], kind='stable')]:
+                entry = self.entries[i]
+                stored_aspect = entry["size"][0] / entry["size"][1]
+                if entry["key"] != key or abs(size[0] / size[1] / stored_aspect - 1) > self.max_aspect_difference:
+                    continue
+                distance = int(distances[i])
+                self.hits += 1
+                self.hit_distances[distance] += 1
+                return _rescale_result(entry["result"], entry["size"], size), distance
+        return None
+
+    def add(self, phash, size, key, result):
+        with self._lock:
+            self.hashes[self.next] = phash
+            self.entries[self.next] = {"size": size, "key": key, "result": result}
+            self.next = (self.next + 1) % len(self.hashes)
+            self.count = min(self.count + 1, len(self.hashes))
+
+    def audit(self, cached, fresh, distance):
+        """Record whether a match at this distance returned the same faces as a full computation"""
+        false_match = not _results_agree(cached, fresh, PHASH_AUDIT_MIN_COSINE)
+        with self._lock:
+            self.audited += 1
+            if false_match:
+                self.false_matches += 1
+                self.false_match_distances[distance] += 1
+        if false_match:
+            logger.error(f"Perceptual hash false match at distance {distance}")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "entries": self.count,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "audited": self.audited,
+                "false_matches": self.false_matches,
+                "hit_distances": list(self.hit_distances),
+                "false_match_distances": list(self.false_match_distances)
+            }
+
+phash_index = PerceptualHashIndex(PHASH_INDEX_SIZE, PHASH_MAX_DISTANCE)
+
+def options_key(model_name=DEFAULT_MODEL, models=None, face_filters=None, tiled=False):
+    """Hashable form of the request options that change a result"""
+    return (model_name, tuple(models or ()), tuple(sorted((face_filters or {}).items())), tiled)
+
+def _represent_image(image, deadline=None, model_name=DEFAULT_MODEL, models=None, face_filters=None, tiled=False):
+    """Embed the faces of a DecodedImage, reusing the result of a near-duplicate if one is indexed"""
+    if not PHASH_ENABLED:
+        return _represent_faces(image, deadline, model_name, models, face_filters, tiled)
+
+    key = options_key(model_name, models, face_filters, tiled)
+    phash = perceptual_hash(image.img)
+    match = phash_index.lookup(phash, image.original_size, key)
+    if match is not None and not PHASH_AUDIT:
+        return match[0]
+
+    result = _represent_faces(image, deadline, model_name, models, face_filters, tiled)
+    if match is not None:
+        phash_index.audit(match[0], result, match[1])
+    else:
+        phash_index.add(phash, image.original_size, key, result)
+    return result
+
+# Embedding cache. Results are stored as packed binary records (float32 embeddings) keyed
+# by the SHA-256 of the image bytes, the models and the detection options. Each worker
+# keeps an LRU of EMBEDDING_CACHE_MB; with EMBEDDING_CACHE_URL (redis:// or rediss://)
+# misses fall through to a Redis-protocol server shared by all instances of the endpoint.
+# Batches look up a whole read-ahead window with one pipelined round trip. Cache errors
+# are logged and treated as misses, and the server is skipped for EMBEDDING_CACHE_RETRY_S.
+EMBEDDING_CACHE_MB = float(os.environ.get('EMBEDDING_CACHE_MB', '64'))
+EMBEDDING_CACHE_URL = os.environ.get('EMBEDDING_CACHE_URL')
+EMBEDDING_CACHE_TTL_S = int(os.environ.get('EMBEDDING_CACHE_TTL_S', str(7 * 24 * 3600)))
+EMBEDDING_CACHE_TIMEOUT_S = float(os.environ.get('EMBEDDING_CACHE_TIMEOUT_S', '0.1'))
+EMBEDDING_CACHE_RETRY_S = float(os.environ.get('EMBEDDING_CACHE_RETRY_S', '30'))
+EMBEDDING_CACHE_PREFIX = os.environ.get('EMBEDDING_CACHE_PREFIX', 'faces:v1')
+
+def pack_faces(faces):
+    return b''.join(encode_binary_record(face) for face in faces)
+
+def unpack_faces(data):
+    faces, offset = [], 0
+    while offset < len(data):
+        face, offset = decode_binary_record(data, offset)
+        faces.append(face)
+    return faces
+
+class LocalEmbeddingCache:
+    """LRU of packed results in this worker process, bounded by their size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            self._entries[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisError(Exception):
+    pass
+
+class RedisCache:
+    """Minimal Redis protocol (RESP) client with one connection per thread.
+
+    Commands are sent as a pipeline: all of them are written before any reply is read.
+    """
+
+    def __init__(self, url, timeout=EMBEDDING_CACHE_TIMEOUT_S, retry_after=EMBEDDING_CACHE_RETRY_S):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.username = parsed.username
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.tls = parsed.scheme == 'rediss'
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.errors = 0
+        self._down_until = 0
+        self._local = threading.local()
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            arg = arg.encode() if isinstance(arg, str) else arg
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by the cache server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            value = reader.read(length + 2)
+            if len(value) != length + 2:
+                raise ConnectionError("Connection closed by the cache server")
+            return value[:-2]
+        if kind == b'*':
+            count = int(rest)
+            return None if count < 0 else [self._read(reader) for _ in range(count)]
+        if kind in (b'+', b':'):
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode(errors='replace'))
+        raise ConnectionError(f"Unexpected reply from the cache server: {line[:20]!r}")
+
+    def _connection(self):
+        # Connections are per thread, and re-created in forked workers
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection[0] == os.getpid():
+            return connection[1:]
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        reader = sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.username, self.password) if self.username else ('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', str(self.db)))
+        if setup:
+            sock.sendall(b''.join(self._encode(command) for command in setup))
+            for _ in setup:
+                self._read(reader)
+        self._local.connection = (os.getpid(), sock, reader)
+        return sock, reader
+
+    def execute(self, commands):
+        """Run commands in one round trip and return their replies, or None if the cache is unavailable"""
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            sock, reader = self._connection()
+            sock.sendall(b''.join(self._encode(command) for command in commands))
+            return [self._read(reader) for _ in commands]
+        except (OSError, ValueError, RedisError) as e:
+            connection = getattr(self._local, 'connection', None)
+            self._local.connection = None
+            if connection is not None:
+                connection[1].close()
+            self.errors += 1
+            self._down_until = time.monotonic() + self.retry_after
+            logger.error(f"Embedding cache {self.host}:{self.port} unavailable: {e}")
+            return None
+
+class EmbeddingCache:
+    """Results by content hash and options: the worker's LRU first, then the shared tier"""
+
+    def __init__(self, local, remote=None, ttl=EMBEDDING_CACHE_TTL_S):
+        self.local = local
+        self.remote = remote
+        self.ttl = ttl
+        self.enabled = local.max_bytes > 0 or remote is not None
+        self.lookups = 0
+        self.local_hits = 0
+        self.remote_hits = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image, options):
+        model_name, models = options[0], options[1]
+        detection = hashlib.sha256(repr(options[2:]).encode()).hexdigest()[:16]
+        return f"{EMBEDDING_CACHE_PREFIX}:{'+'.join(models or (model_name,))}:{detection}:{image.content_hash}"
+
+    def get_many(self, keys):
+        """Return the cached results of keys (None for misses), with one remote round trip"""
+        values = [self.local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        local_hits, remote_hits = len(keys) - len(missing), 0
+        if missing and self.remote is not None:
+            replies = self.remote.execute([('GET', keys[i]) for i in missing]) or ()
+            for i, value in zip(missing, replies):
+                if value is not None:
+                    self.local.put(keys[i], value)
+                    values[i] = value
+                    remote_hits += 1
+        with self._lock:
+            self.lookups += len(keys)
+            self.local_hits += local_hits
+            self.remote_hits += remote_hits
+        return [None if value is None else unpack_faces(value) for value in values]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, faces):
+        value = pack_faces(faces)
+        self.local.put(key, value)
+        if self.remote is not None:
+            self.remote.execute([('SET', key, value, 'EX', str(self.ttl))])
+
+    def snapshot(self):
+        with self._lock:
+            hits = self.local_hits + self.remote_hits
+            return {
+                "entries": len(self.local),
+                "size_mb": round(self.local.nbytes / (1024 * 1024), 1),
+                "lookups": self.lookups,
+                "local_hits": self.local_hits,
+                "remote_hits": self.remote_hits,
+                "hit_rate": round(hits / self.lookups, 4) if self.lookups else 0.0,
+                "remote_errors": self.remote.errors if self.remote is not None else 0
+            }
+
+embedding_cache = EmbeddingCache(
+    LocalEmbeddingCache(int(EMBEDDING_CACHE_MB * 1024 * 1024)),
+    RedisCache(EMBEDDING_CACHE_URL) if EMBEDDING_CACHE_URL else None
+)
+
+# In-flight coalescing: concurrent requests for the same S3 object, or for identical image
+# bytes, wait for the first one and share its result instead of repeating the work.
+COALESCE_INFLIGHT = os.environ.get('COALESCE_INFLIGHT', '1') == '1'
+
+class SingleFlight:
+    """Run at most one computation per key at a time and share its result with concurrent callers.
+
+    Failures that are specific to the first caller (its deadline, a full queue) are not
+    shared: waiting callers then run the computation themselves.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, deadline=None):
+        if not self.enabled:
+            return fn()
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                future.set_result(result)
+                return result
+
+            try:
+                return future.result(timeout=None if deadline is None else max(0, deadline.remaining()))
+            except FutureTimeout:
+                raise DeadlineExceeded("Request deadline exceeded waiting for an identical request")
+            except RequestRejected as e:
+                if type(e) in (RequestRejected, QueueFull, DeadlineExceeded):
+                    continue
+                raise
+
+    def snapshot(self):
+        with self._lock:
+            return {"inflight": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced}
+
+inflight = SingleFlight(COALESCE_INFLIGHT)
+
+def represent_image(image, deadline=None, model_name=DEFAULT_MODEL, models=None, face_filters=None, tiled=False):
+    """Embed the faces of a DecodedImage, from the embedding cache if possible.
+
+    Concurrent requests for the same bytes share one cache lookup and computation.
+    """
+    if not image.data:
+        return _represent_image(image, deadline, model_name, models, face_filters, tiled)
+    options = options_key(model_name, models, face_filters, tiled)
+
+    def compute():
+        cache_key = EmbeddingCache.key(image, options) if embedding_cache.enabled else None
+        result = None
+        if image.cache_lookup is not None and image.cache_lookup[0] == cache_key:
+            result = image.cache_lookup[1]
+        elif cache_key:
+            result = embedding_cache.get(cache_key)
+        if result is None:
+            result = _represent_image(image, deadline, model_name, models, face_filters, tiled)
+            if cache_key:
+                embedding_cache.put(cache_key, result)
+        return result
+
+    return inflight.do(('content', image.content_hash, options), compute, deadline)
+
+def parse_priority(data, default=DEFAULT_PRIORITY):
+    """Read the priority lane of a request payload"""
+    priority = data.get('priority', default)
+    if priority not in LANES:
+        raise BadRequest(f"priority must be one of {', '.join(LANES)}")
+    return priority
+
+def parse_timeout(data):
+    """Seconds a request may take: REQUEST_TIMEOUT_S, shortened (never extended) by timeout_ms"""
+    if 'timeout_ms' not in data:
+        return REQUEST_TIMEOUT_S
+    try:
+        timeout_ms = float(data['timeout_ms'])
+    except (TypeError, ValueError):
+        raise BadRequest("timeout_ms must be a number")
+    if not timeout_ms > 0:
+        raise BadRequest("timeout_ms must be greater than 0")
+    return min(REQUEST_TIMEOUT_S, timeout_ms / 1000)
+
+def parse_media_options(data):
+    """Read the sampling / fps fields of a video or animation request"""
+    sampling = data.get('sampling', 'fps')
+    if sampling not in ('fps', 'scene'):
+        raise BadRequest("sampling must be fps or scene")
+    try:
+        sample_fps = float(data.get('fps', VIDEO_SAMPLE_FPS))
+    except (TypeError, ValueError):
+        raise BadRequest("fps must be a number")
+    if not sample_fps > 0:
+        raise BadRequest("fps must be greater than 0")
+    return sampling, sample_fps
+
+def parse_request_options(data):
+    """Read the model selection and face detection fields of a request payload, and check its keys"""
+    model_name = data.get('model_name', DEFAULT_MODEL)
+    models = data.get('models')
+    if models is not None and (not isinstance(models, list) or not models):
+        raise BadRequest("models must be a non-empty list of model names")
+    for name in (models or [model_name]):
+        if name not in MODELS:
+            raise BadRequest(f"Unsupported model {name}, available models: {', '.join(MODELS)}")
+
+    try:
+        face_filters = {
+            "max_faces": int(data.get('max_faces', MAX_FACES)),
+            "min_face_px": int(data.get('min_face_px', MIN_FACE_PX)),
+            "min_confidence": float(data.get('min_confidence', MIN_CONFIDENCE)),
+            "rank_by": data.get('rank_faces_by', RANK_FACES_BY)
+        }
+    except (TypeError, ValueError):
+        raise BadRequest("max_faces, min_face_px and min_confidence must be numbers")
+    if face_filters["max_faces"] < 0 or face_filters["min_face_px"] < 0:
+        raise BadRequest("max_faces and min_face_px must not be negative")
+    if face_filters["rank_by"] not in ('area', 'confidence'):
+        raise BadRequest("rank_faces_by must be area or confidence")
+    if not (face_filters["max_faces"] or face_filters["min_face_px"] or face_filters["min_confidence"]):
+        face_filters = None
+    tiled = data.get('tiled', TILED_DETECTION)
+    if not isinstance(tiled, bool):
+        raise BadRequest("tiled must be true or false")
+    if 'keys' in data:
+        keys = data['keys']
+        if not isinstance(keys, list) or not keys or not all(isinstance(key, str) and key for key in keys):
+            raise BadRequest("keys must be a non-empty list of object keys")
+        if len(keys) > MAX_BATCH_KEYS:
+            raise BadRequest(f"A batch may have at most {MAX_BATCH_KEYS} keys")
+    return {"model_name": model_name, "models": models, "face_filters": face_filters, "tiled": tiled}
+
+# Read-ahead for batch requests: how many images may be fetched/decoded ahead of
+# the one being embedded, and how many decoded bytes may be buffered at once.
+PREFETCH_DEPTH = int(os.environ.get('PREFETCH_DEPTH', '4'))
+PREFETCH_MAX_MB = int(os.environ.get('PREFETCH_MAX_MB', '256'))
+
+class ImagePrefetcher:
+    """Download and decode the images of a batch ahead of inference.
+
+    Iterating yields (key, image, error) tuples in request order. Up to `depth`
+    images are fetched and decoded in the background while the caller runs the
+    model on the current one. No new download starts while the decoded images
+    waiting to be consumed exceed `max_bytes`, so memory stays flat for large batches.
+    """
+
+    def __init__(self, bucket, keys, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_MB * 1024 * 1024):
+        self.bucket = bucket
+        self.keys = list(keys)
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self._buffered_bytes = 0
+        self._pending = 0  # submitted and not yet released by the consumer
+        self._closed = False
+        self._cond = threading.Condition()
+        self._futures = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix='prefetch')
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+    def _produce(self):
+        for key in self.keys:
+            with self._cond:
+                # The image being embedded counts as pending, so allow depth + 1
+                while not self._closed and (
+                    self._pending > self.depth
+                    or (self._pending > 0 and self._buffered_bytes >= self.max_bytes)
+                ):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                self._pending += 1
+            self._futures.put((key, self._executor.submit(self._load, key)))
+
+    def _load(self, key):
+        image = decode_image(fetch_image_bytes(self.bucket, key))
+        with self._cond:
+            self._buffered_bytes += image.nbytes
+        return image
+
+    def __iter__(self):
+        try:
+            for _ in self.keys:
+                key, future = self._futures.get()
+                try:
+                    img, error = future.result(), None
+                except Exception as e:
+                    img, error = None, e
+                yield key, img, error
+                # The caller is done with this image once it asks for the next one
+                with self._cond:
+                    self._pending -= 1
+                    if img is not None:
+                        self._buffered_bytes -= img.nbytes
+                    self._cond.notify_all()
+                img = None
+        finally:
+            self.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def warm_embedding_cache(images, options, window=PREFETCH_DEPTH):
+    """Pass (key, image, error) items through, looking up each window's cached results at once.
+
+    The outcome is kept on the images, so represent_image does not look them up again.
+    """
+    images = iter(images)
+    while True:
+        items = list(islice(images, max(1, window)))
+        if not items:
+            return
+        if embedding_cache.enabled and embedding_cache.remote is not None:
+            key = options_key(**options)
+            found = [image for _, image, error in items if error is None and image.data]
+            keys = [EmbeddingCache.key(image, key) for image in found]
+            for image, cache_key, result in zip(found, keys, embedding_cache.get_many(keys)):
+                image.cache_lookup = (cache_key, result)
+        yield from items
+
+def analyse_batch(bucket, keys, deadline, priority=DEFAULT_PRIORITY, options=None):
+    """Embed every key of a batch, downloading the next ones while the model runs.
+
+    Each image holds an inference slot only while it is embedded, so freed slots can go to
+    other lanes between images. Images that fail get an error entry instead of failing the
+    whole batch.
+    """
+    slot = admission.acquire(deadline, priority)
+    try:
+        results = []
+        for key, img, error in warm_embedding_cache(ImagePrefetcher(bucket, keys), options or {}):
+            deadline.check(f"analysing {key}")
+            print(f'analysing: {bucket}/{key}')
+            if error is None:
+                slot = slot.renew(deadline)
+                try:
+                    results.append({"key": key, "faces": represent_image(img, deadline, **(options or {}))})
+                    continue
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    error = e
+                finally:
+                    slot.release()
+            logger.error(f"Error processing image {key}: {error}")
+            results.append({
+                "key": key,
+                "error_type": type(error).__name__,
+                "error_message": str(error)
+            })
+        return results
+    finally:
+        slot.release()
+
+def analyse_object(bucket, key, deadline, priority=DEFAULT_PRIORITY, options=None):
+    """Embed the faces of one S3 object.
+
+    Concurrent requests for the same object share one download and inference, and only
+    the first one takes an inference slot.
+    """
+    options = options or {}
+
+    def analyse():
+        with admission.admit(deadline, priority):
+            print(f'analysing: {bucket}/{key}')
+            image = decode_image(fetch_image_bytes(bucket, key))
+            deadline.check("detection")
+            return represent_image(image, deadline, **options)
+
+    # Keyed by lane too, so an interactive request never waits on a queued bulk one
+    return inflight.do(('object', bucket, key, priority, options_key(**options)), analyse, deadline)
+
+# Asynchronous jobs. A request with "async": true is queued and answered at once with a
+# job id. Job threads in every worker run it like a synchronous request, in the bulk lane
+# and with JOB_TIMEOUT_S instead of the invocation timeout, and write status.json and
+# result.json under <output>/<job_id>/. The output is the request's "output" S3 URI or
+# JOB_OUTPUT, which may also be a local directory. JOB_QUEUE is "memory" (one queue per
+# worker) or a directory whose jobs are shared by all workers of the container.
+JOB_QUEUE = os.environ.get('JOB_QUEUE', 'memory')
+JOB_OUTPUT = os.environ.get('JOB_OUTPUT')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_TIMEOUT_S = float(os.environ.get('JOB_TIMEOUT_S', '900'))
+JOB_PRIORITY = os.environ.get('JOB_PRIORITY', 'bulk')
+JOB_POLL_S = float(os.environ.get('JOB_POLL_S', '0.5'))
+
+_JOB_ID = re.compile(r'^[0-9]{13}-[0-9a-f]{12}$')
+
+class JobNotFound(RequestRejected):
+    status = 404
+
+def new_job_id():
+    # Millisecond timestamp first, so job ids sort in submission order
+    return f'{int(time.time() * 1000):013d}-{uuid4().hex[:12]}'
+
+class MemoryJobQueue:
+    """Jobs queued in this worker process"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, job_id, payload):
+        self._queue.put((job_id, payload))
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, job_id):
+        pass
+
+class FilesystemJobQueue:
+    """Jobs queued as files in a directory, claimed by renaming so each one runs once"""
+
+    def __init__(self, directory):
+        self.pending = os.path.join(directory, 'pending')
+        self.claimed = os.path.join(directory, 'claimed')
+        os.makedirs(self.pending, exist_ok=True)
+        os.makedirs(self.claimed, exist_ok=True)
+
+    def put(self, job_id, payload):
+        # Written under a hidden name first, so a partial file is never claimed
+        tmp = os.path.join(self.pending, f'.{job_id}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmp, os.path.join(self.pending, f'{job_id}.json'))
+
+    def get(self, timeout):
+        end = time.monotonic() + timeout
+        while True:
+            for name in sorted(os.listdir(self.pending)):
+                if name.startswith('.'):
+                    continue
+                claimed = os.path.join(self.claimed, name)
+                try:
+                    os.rename(os.path.join(self.pending, name), claimed)
+                except FileNotFoundError:
+                    continue  # claimed by another worker
+                with open(claimed) as f:
+                    return name[:-len('.json')], json.load(f)
+            if time.monotonic() >= end:
+                return None
+            time.sleep(JOB_POLL_S)
+
+    def done(self, job_id):
+        try:
+            os.remove(os.path.join(self.claimed, f'{job_id}.json'))
+        except FileNotFoundError:
+            pass
+
+class JobStore:
+    """Status and result documents of jobs, under an s3:// URI or a local directory"""
+
+    def __init__(self, location):
+        self.location = location
+        if location.startswith('s3://'):
+            self.bucket, _, prefix = location[len('s3://'):].partition('/')
+            self.prefix = prefix.strip('/')
+        else:
+            self.bucket, self.prefix = None, location
+
+    def _key(self, job_id, name):
+        return '/'.join(part for part in (self.prefix, job_id, name) if part)
+
+    def write(self, job_id, name, document):
+        """Store a JSON document of a job and return its location"""
+        body = json.dumps(document).encode()
+        if self.bucket:
+            key = self._key(job_id, name)
+            get_s3_client().put_object(Bucket=self.bucket, Key=key, Body=body, ContentType='application/json')
+            return f's3://{self.bucket}/{key}'
+        directory = os.path.join(self.prefix, job_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def read(self, job_id, name):
+        """Return a JSON document of a job, or None if it does not exist"""
+        if self.bucket:
+            client = get_s3_client()
+            try:
+                response = client.get_object(Bucket=self.bucket, Key=self._key(job_id, name))
+            except client.exceptions.NoSuchKey:
+                return None
+            return json.loads(response['Body'].read())
+        try:
+            with open(os.path.join(self.prefix, job_id, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+def job_output(data):
+    """Output location of a job: the request's S3 URI or JOB_OUTPUT"""
+    output = data.get('output')
+    if output is not None and not (isinstance(output, str) and output.startswith('s3://')):
+        raise BadRequest("output must be an s3:// URI")
+    output = output or JOB_OUTPUT
+    if not output:
+        raise BadRequest("Asynchronous requests need an output S3 URI (or JOB_OUTPUT on the server)")
+    return output
+
+_job_queue = None
+_job_workers_pid = None
+_job_workers_lock = threading.Lock()
+
+def start_job_workers():
+    """Start this worker process's job queue consumers, once per process"""
+    global _job_queue, _job_workers_pid
+    with _job_workers_lock:
+        if _job_workers_pid == os.getpid():
+            return _job_queue
+        _job_queue = MemoryJobQueue() if JOB_QUEUE == 'memory' else FilesystemJobQueue(JOB_QUEUE)
+        _job_workers_pid = os.getpid()
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=_run_jobs, args=(_job_queue,), daemon=True, name=f'job-{i}').start()
+        return _job_queue
+
+def consume_shared_jobs():
+    """Start the job threads of a directory queue from any request, so every worker consumes it.
+
+    A memory queue only receives jobs submitted to this worker, which start it themselves.
+    Errors are logged, not raised, since they must not fail synchronous requests.
+    """
+    if JOB_QUEUE == 'memory' or _job_workers_pid == os.getpid():
+        return
+    try:
+        start_job_workers()
+    except OSError as e:
+        logger.error(f"Job queue {JOB_QUEUE} unavailable: {e}")
+
+def submit_job(data):
+    """Validate a request, queue it as a job and return its initial status"""
+    if 'bucket' not in data or ('key' not in data and 'keys' not in data):
+        raise BadRequest("Jobs need a bucket and a key or keys")
+    parse_request_options(data)
+    parse_priority(data, JOB_PRIORITY)
+    if (data.get('media') or (media_type(data['key']) if 'key' in data else 'image')) in ('video', 'animation'):
+        parse_media_options(data)
+    output = job_output(data)
+    job_id = new_job_id()
+    status = {"job_id": job_id, "status": "queued", "submitted_at": time.time(), "output": output}
+    JobStore(output).write(job_id, 'status.json', status)
+    payload = {name: value for name, value in data.items() if name != 'async'}
+    payload.update(output=output, submitted_at=status["submitted_at"])
+    start_job_workers().put(job_id, payload)
+    print(f'queued job {job_id}')
+    return status
+
+def job_status(job_id, output=None):
+    """Return the latest status of a job"""
+    if not isinstance(job_id, str) or not _JOB_ID.match(job_id):
+        raise BadRequest("Invalid job id")
+    status = JobStore(job_output({"output": output})).read(job_id, 'status.json')
+    if status is None:
+        raise JobNotFound(f"Unknown job {job_id}")
+    return status
+
+def run_job(data):
+    """Compute the result of a job payload like a synchronous, non-streaming request"""
+    deadline = Deadline(JOB_TIMEOUT_S)
+    options = parse_request_options(data)
+    priority = parse_priority(data, JOB_PRIORITY)
+    bucket = data['bucket']
+    media = data.get('media') or (media_type(data['key']) if 'key' in data else 'image')
+    if media in ('video', 'animation'):
+        sampling, sample_fps = parse_media_options(data)
+        # Download before taking a slot, so inference goes on while the video arrives
+        source = MediaSource(bucket, data['key'], media)
+        try:
+            while True:
+                try:
+                    slot = admission.acquire(deadline, priority)
+                    break
+                except QueueFull:
+                    deadline.check("queueing the job")
+                    time.sleep(JOB_POLL_S)
+            try:
+                return list(analyse_media(source, deadline, slot, sampling, sample_fps, **options))
+            finally:
+                slot.release()
+        finally:
+            source.close()
+    while True:
+        try:
+            if 'keys' in data:
+                return analyse_batch(bucket, data['keys'], deadline, priority, options)
+            return analyse_object(bucket, data['key'], deadline, priority, options)
+        except QueueFull:
+            # Jobs wait for room in their lane instead of failing
+            deadline.check("queueing the job")
+            time.sleep(JOB_POLL_S)
+
+def _run_jobs(job_queue):
+    while True:
+        job = job_queue.get(timeout=1)
+        if job is None:
+            continue
+        job_id, data = job
+        store = JobStore(data['output'])
+        status = {"job_id": job_id, "submitted_at": data.get('submitted_at'), "output": data['output']}
+        try:
+            status.update(status="running", started_at=time.time())
+            store.write(job_id, 'status.json', status)
+            print(f'running job {job_id}')
+            status.update(status="succeeded", result=store.write(job_id, 'result.json', run_job(data)))
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}", exc_info=not isinstance(e, RequestRejected))
+            status.update(status="failed", error_type=type(e).__name__, error_message=str(e))
+        status["finished_at"] = time.time()
+        try:
+            store.write(job_id, 'status.json', status)
+        except Exception as e:
+            logger.error(f"Error writing the status of job {job_id}: {e}")
+        job_queue.done(job_id)
 
 @app.route('/ping', methods=['GET'])
 def ping():
     return jsonify({"message": "Pong"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = admission.snapshot()
+    stats.update(memory_stats())
+    if PHASH_ENABLED:
+        stats["phash"] = phash_index.snapshot()
+    stats["coalescing"] = inflight.snapshot()
+    if embedding_cache.enabled:
+        stats["embedding_cache"] = embedding_cache.snapshot()
+    return jsonify(stats)
+
+@app.teardown_request
+def release_request_memory(exc):
+    # Return the freed decode and activation buffers to the OS instead of letting the
+    # worker's heap stay at the size of the largest request it has seen
+    if LOW_MEMORY and request.endpoint == 'get_embeddings':
+        gc.collect()
+        if _libc is not None:
+            _libc.malloc_trim(0)
+
 @app.route('/invocations', methods=['POST'])
 def get_embeddings():
+    s3_bucket = s3_key = None
     try:
+        start_metrics_publisher()
+        consume_shared_jobs()
         data = request.json  # This should auto-parse the JSON request payload
+        # Status of an asynchronous job, for callers that can only reach /invocations
+        if 'job_id' in data:
+            return json.dumps(job_status(data['job_id'], data.get('output')))
         s3_bucket = data['bucket']
+        s3_key = data.get('key')
+
+        # Callers may shorten (never extend) the time they are willing to wait
+        deadline = Deadline(parse_timeout(data))
+        options = parse_request_options(data)
+        priority = parse_priority(data)
+        if data.get('async'):
+            return json.dumps(submit_job(data))
+
+        # Videos and animated images always stream, one record per face track. Streaming
+        # responses release their slot and source when they are closed, not when this returns
+        stream_format = negotiate_stream_format(data)
+        media = data.get('media') or (media_type(s3_key) if s3_key else 'image')
+        if media in ('video', 'animation'):
+            sampling, sample_fps = parse_media_options(data)
+            print(f'analysing {media}: {s3_bucket}/{s3_key}')
+            # Download before taking a slot, so inference goes on while the video arrives
+            source = MediaSource(s3_bucket, s3_key, media)
+            slot = None
+            try:
+                deadline.check("analysis")
+                slot = admission.acquire(deadline, priority)
+                records = analyse_media(source, deadline, slot, sampling, sample_fps, **options)
+                return streaming_response(records, stream_format or 'ndjson', [source.close, slot.release])
+            except Exception:
+                source.close()
+                if slot is not None:
+                    slot.release()
+                raise
+
+        if stream_format is not None:
+            slot = admission.acquire(deadline, priority)
+            prefetcher = None
+            try:
+                if 'keys' in data:
+                    prefetcher = ImagePrefetcher(s3_bucket, data['keys'])
+                    images = warm_embedding_cache(prefetcher, options)
+                    on_close = [prefetcher.close, slot.release]
+                else:
+                    images = [(s3_key, decode_image(fetch_image_bytes(s3_bucket, s3_key)), None)]
+                    on_close = [slot.release]
+                records = stream_image_records(images, deadline, slot, **options)
+                return streaming_response(records, stream_format, on_close)
+            except Exception:
+                if prefetcher is not None:
+                    prefetcher.close()
+                slot.release()
+                raise
+
+        if 'keys' in data:
+            s3_key = f"[{len(data['keys'])} keys]"
+            return json.dumps(analyse_batch(s3_bucket, data['keys'], deadline, priority, options))
         s3_key = data['key']
+        return json.dumps(analyse_object(s3_bucket, s3_key, deadline, priority, options))
 
-        # Generate a secure random filename instead of using the S3 key directly
-        secure_filename = str(uuid4())
-        temp_dir = tempfile.gettempdir()
-        file_path = os.path.normpath(os.path.join(temp_dir, secure_filename))
-        if not file_path.startswith(temp_dir):
-            raise Exception("Invalid file path: Potential directory traversal detected.")
-        
-        # Download from S3 using the original key but store with the secure filename
-        s3.download_file(s3_bucket, s3_key, file_path)
-
-        print(f'analysing: {file_path}')
-        result = DeepFace.represent(
-                img_path = file_path,
-                model_name = "Facenet512",
-                enforce_detection = True,
-                detector_backend="retinaface"
-            )
-        
-        # Delete the temp file using the secure path
-        os.remove(file_path)
+    except RequestRejected as e:
+        # Expected under load or for oversized input, so no stack trace
+        logger.error(f"Rejected request for {s3_bucket}/{s3_key}: {e}")
+        error_response = {
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "error_details": f"Failed to process image from {s3_bucket}/{s3_key}"
+        }
+        headers = {'Retry-After': '1'} if isinstance(e, QueueFull) else {}
+        return json.dumps(error_response), e.status, headers
 
-        return json.dumps(result)
-    
     except Exception as e:
         # Log the full error details on the server
         error_message = str(e)
@@ -68,6 +2311,25 @@ def get_embeddings():
         }
         return json.dumps(error_response), 500
     
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    return _job_response(lambda: (submit_job(request.json), 202))
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    return _job_response(lambda: (job_status(job_id, request.args.get('output')), 200))
+
+def _job_response(handler):
+    try:
+        document, status = handler()
+        return json.dumps(document), status
+    except RequestRejected as e:
+        logger.error(f"Rejected job request: {e}")
+        return json.dumps({"error_type": type(e).__name__, "error_message": str(e)}), e.status
+    except Exception as e:
+        logger.error(f"Error handling job request: {e}", exc_info=True)
+        return json.dumps({"error_type": type(e).__name__, "error_message": str(e)}), 500
+
 @app.route('/test', methods=['GET'])
 def get_local_image_embeddings():
     try:
@@ -75,12 +2337,8 @@ def get_local_image_embeddings():
         local_image_path = '/tmp/trudeau-3ppl.jpg'
 
         print(f'Analyzing local image: {local_image_path}')
-        result = DeepFace.represent(
-            img_path=local_image_path,
-            model_name="Facenet512",
-            enforce_detection=True,
-            detector_backend="retinaface"
-        )
+        with open(local_image_path, 'rb') as f:
+            result = represent_image(decode_image(f.read()))
 
         return jsonify(result)
 
@@ -90,5 +2348,17 @@ def get_local_image_embeddings():
         # Return a generic error message to the client
         return jsonify({"error": "An error occurred while processing the image"}), 500
 
+def _warm_up_in_background():
+    try:
+        warm_up()
+    except Exception as e:
+        logger.error(f"Warm-up failed, models will load on first use: {e}", exc_info=True)
+
+# gunicorn imports the app in each worker after forking, so every worker warms up its own
+# models. Warm-up runs in a thread: model downloads and the detection passes can take longer
+# than GUNICORN_TIMEOUT, which also bounds loading the app, and a failure must not kill the worker.
+if WARMUP:
+    threading.Thread(target=_warm_up_in_background, name='warm-up', daemon=True).start()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Instance sizing for the Defender Image Analyzer endpoints
+
+Benchmarks the analyzer image locally under Docker CPU and memory limits that match each
+SageMaker instance type, at several worker, thread and batch settings. It combines the
+measured throughput and latency with a price table into a cost per 1,000 faces, and
+recommends an instance type, worker configuration and autoscaling target for each
+traffic profile.
+
+Example:
+    python3 scripts/size_instances.py --bucket my-bucket --keys trudeau.jpg trudeau-3ppl.jpg \\
+        --instances ml.c5.large ml.c6i.2xlarge --output sizing.json
+    python3 scripts/size_instances.py --from-results sizing.json --profile interactive=5:800:1
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import subprocess
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# vCPUs, memory (GiB) and on-demand USD per hour of SageMaker real-time inference in
+# us-east-1. Check the SageMaker pricing page (or pass --prices) before relying on them.
+INSTANCES = {
+    'ml.c5.large': (2, 4, 0.102),
+    'ml.c5.xlarge': (4, 8, 0.204),
+    'ml.c5.2xlarge': (8, 16, 0.408),
+    'ml.c6i.large': (2, 4, 0.102),
+    'ml.c6i.xlarge': (4, 8, 0.204),
+    'ml.c6i.2xlarge': (8, 16, 0.408),
+    'ml.c6i.4xlarge': (16, 32, 0.816),
+}
+
+# name: (requests per second, p99 latency target in ms, images per request)
+DEFAULT_PROFILES = {
+    'interactive': (2.0, 1000.0, 1),
+    'bulk': (20.0, 30000.0, 8),
+}
+
+# Autoscaling targets leave this much headroom below the measured capacity
+SCALING_HEADROOM = 0.7
+
+def run_command(command, description=""):
+    """Run a command and return its output"""
+    print(f"🔄 {description}")
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        return result.stdout.strip()
+    except subprocess.CalledProcessError as e:
+        print(f"❌ {description} - Failed")
+        print(f"   Error: {e.stderr}")
+        raise
+
+def start_container(image, instance_type, workers, threads, port, env=()):
+    """Run the analyzer with the CPU and memory of instance_type and wait until it answers /ping"""
+    vcpus, memory_gib, _ = INSTANCES[instance_type]
+    command = [
+        'docker', 'run', '-d', '--rm', f'--cpus={vcpus}', f'--memory={memory_gib}g', '-p', f'{port}:8080',
+        '-e', f'GUNICORN_WORKERS={workers}', '-e', f'GUNICORN_THREADS={threads}',
+    ]
+    # S3 access for /invocations: pass the caller's credentials through
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_DEFAULT_REGION', 'AWS_PROFILE'):
+        if name in os.environ:
+            command += ['-e', name]
+    aws_config = os.path.expanduser('~/.aws')
+    if os.path.isdir(aws_config):
+        command += ['-v', f'{aws_config}:/root/.aws:ro']
+    for item in env:
+        command += ['-e', item]
+    container = run_command(command + [image], f"Starting {image} as {instance_type} ({workers}x{threads})")
+
+    deadline = time.monotonic() + 600  # model downloads and warm-up
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://localhost:{port}/ping', timeout=5) as response:
+                if response.status == 200:
+                    return container
+        except OSError:
+            pass
+        if not run_command(['docker', 'ps', '-q', '--filter', f'id={container}'], "Checking the container"):
+            raise Exception("Container exited while starting (out of memory?)")
+        time.sleep(2)
+    stop_container(container)
+    raise Exception("Container did not answer /ping within 600s")
+
+def stop_container(container):
+    subprocess.run(['docker', 'stop', container], capture_output=True)
+
+def invoke(port, payload):
+    """POST one request and return (latency in seconds, faces, ok)"""
+    request = urllib.request.Request(
+        f'http://localhost:{port}/invocations', data=json.dumps(payload).encode(),
+        headers={'Content-Type': 'application/json'}
+    )
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            result = json.loads(response.read())
+    except OSError:
+        return time.monotonic() - start, 0, False
+    latency = time.monotonic() - start
+    if not isinstance(result, list):
+        return latency, 0, False
+    if 'keys' in payload:
+        # One entry per key, with either its faces or an error
+        return latency, sum(len(item.get('faces', [])) for item in result), True
+    return latency, len(result), True
+
+def run_load(port, bucket, keys, batch, concurrency, duration):
+    """Closed-loop load: concurrency clients sending requests back to back for duration seconds"""
+    end = time.monotonic() + duration
+    requests = itertools.cycle(range(len(keys)))
+
+    def client():
+        samples = []
+        while time.monotonic() < end:
+            start = next(requests)
+            if batch == 1:
+                payload = {'bucket': bucket, 'key': keys[start]}
+            else:
+                payload = {'bucket': bucket, 'keys': [keys[(start + i) % len(keys)] for i in range(batch)]}
+            samples.append(invoke(port, payload))
+        return samples
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = [s for result in executor.map(lambda _: client(), range(concurrency)) for s in result]
+    elapsed = time.monotonic() - started
+    latencies = sorted(latency for latency, _, ok in samples if ok)
+    ok_count = len(latencies)
+
+    def percentile(q):
+        return round(1000 * latencies[int(q * (ok_count - 1))], 1) if latencies else None
+
+    return {
+        'concurrency': concurrency,
+        'requests_per_s': round(ok_count / elapsed, 3),
+        'images_per_s': round(ok_count * batch / elapsed, 3),
+        'faces_per_s': round(sum(faces for _, faces, ok in samples if ok) / elapsed, 3),
+        'latency_ms_p50': percentile(0.5),
+        'latency_ms_p99': percentile(0.99),
+        'error_rate': round(1 - ok_count / len(samples), 4) if samples else 1.0
+    }
+
+def benchmark(args):
+    """Measure every instance x workers x threads x batch x concurrency combination"""
+    results = []
+    for instance_type in args.instances:
+        vcpus = INSTANCES[instance_type][0]
+        for workers, threads in itertools.product(args.workers or [1, vcpus], args.threads):
+            container = None
+            try:
+                container = start_container(args.image, instance_type, workers, threads, args.port, args.env)
+                for batch in args.batch_sizes:
+                    # One unmeasured request per batch size warms the caches of the path
+                    invoke(args.port, {'bucket': args.bucket, 'keys': args.keys[:batch]} if batch > 1
+                           else {'bucket': args.bucket, 'key': args.keys[0]})
+                    for concurrency in args.concurrency:
+                        run = run_load(args.port, args.bucket, args.keys, batch, concurrency, args.duration)
+                        run.update(instance_type=instance_type, workers=workers, threads=threads, batch=batch)
+                        print(f"   {instance_type} {workers}x{threads} batch={batch} c={concurrency}: "
+                              f"{run['faces_per_s']} faces/s, p99 {run['latency_ms_p99']} ms, "
+                              f"errors {run['error_rate']:.1%}")
+                        results.append(run)
+            except Exception as e:
+                print(f"❌ {instance_type} {workers}x{threads}: {e}")
+            finally:
+                if container:
+                    stop_container(container)
+    return results
+
+def recommend(results, profiles, prices):
+    """Cheapest configuration per traffic profile that meets its p99 target without errors"""
+    recommendations = {}
+    for name, (rate, p99_target, batch) in profiles.items():
+        options = []
+        for run in results:
+            if run['batch'] != batch or run['error_rate'] > 0 or run['latency_ms_p99'] is None:
+                continue
+            if run['latency_ms_p99'] > p99_target or run['requests_per_s'] <= 0:
+                continue
+            price = prices[run['instance_type']]
+            instances = max(1, math.ceil(rate / (run['requests_per_s'] * SCALING_HEADROOM)))
+            options.append({
+                **run,
+                'instances': instances,
+                'usd_per_hour': round(instances * price, 3),
+                'usd_per_1k_faces': round(price / (run['faces_per_s'] * 3.6), 5) if run['faces_per_s'] else None,
+                # SageMaker's InvocationsPerInstance is counted per minute
+                'target_invocations_per_instance': round(run['requests_per_s'] * 60 * SCALING_HEADROOM, 1)
+            })
+        if options:
+            recommendations[name] = min(options, key=lambda o: (o['usd_per_hour'], o['usd_per_1k_faces'] or 0))
+        else:
+            recommendations[name] = None
+    return recommendations
+
+def parse_profile(value):
+    name, _, spec = value.partition('=')
+    rate, p99, batch = (spec.split(':') + ['1'])[:3]
+    return name, (float(rate), float(p99), int(batch))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analyzer under instance limits and recommend a configuration")
+    parser.add_argument('--image', default='dme-image-analyzer:latest', help='Local Docker image of the analyzer')
+    parser.add_argument('--bucket', help='S3 bucket of the benchmark images')
+    parser.add_argument('--keys', nargs='+', help='S3 keys of representative images')
+    parser.add_argument('--instances', nargs='+', default=['ml.c5.large', 'ml.c6i.2xlarge'], choices=sorted(INSTANCES))
+    parser.add_argument('--workers', nargs='+', type=int, help='GUNICORN_WORKERS values (default: 1 and the vCPU count)')
+    parser.add_argument('--threads', nargs='+', type=int, default=[8], help='GUNICORN_THREADS values')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8], help='Images per request')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 2, 4, 8], help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of load per measurement')
+    parser.add_argument('--env', nargs='*', default=[], help='Extra NAME=VALUE settings for the analyzer')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--profile', nargs='+', type=parse_profile,
+                        help='Traffic profiles as name=requests_per_s:p99_ms[:images_per_request]')
+    parser.add_argument('--prices', help='JSON file of instance type -> USD per hour overriding the built-in prices')
+    parser.add_argument('--from-results', help='Skip the benchmark and reuse the measurements of an earlier --output')
+    parser.add_argument('--output', help='Write measurements and recommendations to this JSON file')
+    args = parser.parse_args()
+
+    prices = {name: price for name, (_, _, price) in INSTANCES.items()}
+    if args.prices:
+        with open(args.prices) as f:
+            prices.update(json.load(f))
+    profiles = dict(args.profile) if args.profile else DEFAULT_PROFILES
+
+    if args.from_results:
+        with open(args.from_results) as f:
+            results = json.load(f)['measurements']
+    else:
+        if not args.bucket or not args.keys:
+            parser.error("--bucket and --keys are required to run the benchmark")
+        print("📏 Defender Image Analyzer - Instance Sizing")
+        print("=" * 45)
+        results = benchmark(args)
+
+    recommendations = recommend(results, profiles, prices)
+    print("-" * 45)
+    for name, option in recommendations.items():
+        rate, p99_target, batch = profiles[name]
+        print(f"🎯 {name} ({rate} req/s, p99 <= {p99_target:.0f} ms, {batch} image(s)/request):")
+        if option is None:
+            print("   ❌ No measured configuration meets this profile")
+            continue
+        print(f"   {option['instances']} x {option['instance_type']} with GUNICORN_WORKERS={option['workers']} "
+              f"GUNICORN_THREADS={option['threads']}")
+        print(f"   ${option['usd_per_hour']}/hour, ${option['usd_per_1k_faces']} per 1k faces, "
+              f"p99 {option['latency_ms_p99']} ms at {option['concurrency']} concurrent requests per instance")
+        print(f"   Autoscaling: target InvocationsPerInstance of {option['target_invocations_per_instance']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'measurements': results, 'prices': prices, 'recommendations': recommendations}, f, indent=2)
+        print(f"📄 Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
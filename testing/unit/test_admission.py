@@ -0,0 +1,171 @@
+import importlib.util
+import os
+import threading
+import time
+import unittest
+
+ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'image-analyzer.py')
+
+def load_analyzer():
+    """Import image-analyzer.py, whose file name is not a module name, without warming up the models"""
+    os.environ['WARMUP'] = '0'
+    spec = importlib.util.spec_from_file_location('image_analyzer', ANALYZER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+analyzer = load_analyzer()
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out waiting for the test condition")
+        time.sleep(0.001)
+
+class TestAdmissionController(unittest.TestCase):
+    def controller(self, interactive_queue=10, bulk_queue=10, scheduling='weighted'):
+        return analyzer.AdmissionController(1, {'interactive': (interactive_queue, 4), 'bulk': (bulk_queue, 1)}, scheduling)
+
+    def grant_order(self, scheduling):
+        """Queue 5 requests per lane behind a held slot and return the lanes in the order they ran"""
+        controller = self.controller(scheduling=scheduling)
+        held = controller.acquire(analyzer.Deadline(5))
+        order = []
+
+        def request(lane):
+            with controller.admit(analyzer.Deadline(5), lane):
+                order.append(lane)
+
+        threads = []
+        for _ in range(5):
+            for lane in ('bulk', 'interactive'):
+                thread = threading.Thread(target=request, args=(lane,))
+                thread.start()
+                threads.append(thread)
+        wait_for(lambda: all(len(lane.waiting) == 5 for lane in controller.lanes.values()))
+        held.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(controller.inflight, 0)
+        return order
+
+    def test_weighted_scheduling_interleaves_the_lanes(self):
+        order = self.grant_order('weighted')
+        # With weights 4:1 every window of five grants has one bulk request
+        self.assertEqual(order[:5].count('bulk'), 1)
+        self.assertEqual(order[5:].count('bulk'), 4)
+
+    def test_strict_scheduling_serves_interactive_first(self):
+        self.assertEqual(self.grant_order('strict'), ['interactive'] * 5 + ['bulk'] * 5)
+
+    def test_full_lane_is_rejected_without_affecting_the_other(self):
+        controller = self.controller(interactive_queue=1, bulk_queue=0)
+        held = controller.acquire(analyzer.Deadline(5))
+        with self.assertRaises(analyzer.QueueFull):
+            controller.acquire(analyzer.Deadline(5), 'bulk')
+
+        waiter = threading.Thread(target=lambda: controller.acquire(analyzer.Deadline(5)).release())
+        waiter.start()
+        wait_for(lambda: len(controller.lanes['interactive'].waiting) == 1)
+        with self.assertRaises(analyzer.QueueFull):
+            controller.acquire(analyzer.Deadline(5))
+        held.release()
+        waiter.join()
+
+        lanes = controller.snapshot()["lanes"]
+        self.assertEqual((lanes["interactive"]["rejected"], lanes["bulk"]["rejected"]), (1, 1))
+        self.assertEqual(lanes["interactive"]["admitted"], 2)
+
+    def test_requeue_skips_the_full_queue_check(self):
+        controller = self.controller(bulk_queue=0)
+        held = controller.acquire(analyzer.Deadline(5), 'bulk')
+        slots = []
+        waiter = threading.Thread(target=lambda: slots.append(controller.acquire(analyzer.Deadline(5), 'bulk', requeue=True)))
+        waiter.start()
+        wait_for(lambda: len(controller.lanes['bulk'].waiting) == 1)
+        held.release()
+        waiter.join()
+        self.assertTrue(slots[0].granted)
+        self.assertEqual(controller.inflight, 1)
+        slots[0].release()
+        self.assertEqual(controller.inflight, 0)
+
+    def test_renew_reuses_a_held_slot_and_requeues_a_released_one(self):
+        controller = self.controller(bulk_queue=0)
+        slot = controller.acquire(analyzer.Deadline(5), 'bulk')
+        self.assertIs(slot.renew(analyzer.Deadline(5)), slot)
+        slot.release()
+        slot.release()  # releasing twice gives back one slot
+        self.assertEqual(controller.inflight, 0)
+        renewed = slot.renew(analyzer.Deadline(5))
+        self.assertIsNot(renewed, slot)
+        self.assertEqual((renewed.lane, controller.inflight), ('bulk', 1))
+        renewed.release()
+
+    def test_deadline_expires_while_queued(self):
+        controller = self.controller()
+        held = controller.acquire(analyzer.Deadline(5))
+        with self.assertRaises(analyzer.RequestRejected) as raised:
+            controller.acquire(analyzer.Deadline(0.05))
+        self.assertNotIsInstance(raised.exception, analyzer.QueueFull)
+        lane = controller.snapshot()["lanes"]["interactive"]
+        self.assertEqual((lane["timed_out"], lane["queue_depth"]), (1, 0))
+        # The expired request is not handed the slot once it frees up
+        held.release()
+        self.assertEqual(controller.inflight, 0)
+
+class TestSingleFlight(unittest.TestCase):
+    def run_with_waiter(self, leader_fn, waiter_fn):
+        """Run leader_fn as the leader of a key and waiter_fn in a caller that arrives while it runs"""
+        flight = analyzer.SingleFlight()
+        started = threading.Event()
+        results = {}
+
+        def leader():
+            started.set()
+            wait_for(lambda: flight.coalesced == 1)
+            return leader_fn()
+
+        def call(name, fn):
+            try:
+                results[name] = flight.do('key', fn, analyzer.Deadline(5))
+            except Exception as e:
+                results[name] = e
+
+        leader_thread = threading.Thread(target=call, args=('leader', leader))
+        leader_thread.start()
+        started.wait()
+        waiter_thread = threading.Thread(target=call, args=('waiter', waiter_fn))
+        waiter_thread.start()
+        leader_thread.join()
+        waiter_thread.join()
+        return flight, results
+
+    def test_waiter_shares_the_leader_result(self):
+        calls = []
+        flight, results = self.run_with_waiter(lambda: calls.append('leader') or 'faces', lambda: calls.append('waiter'))
+        self.assertEqual(results, {'leader': 'faces', 'waiter': 'faces'})
+        self.assertEqual(calls, ['leader'])
+        self.assertEqual(flight.snapshot(), {"inflight": 0, "leaders": 1, "coalesced": 1})
+
+    def test_leader_deadline_is_not_shared(self):
+        def expire():
+            raise analyzer.DeadlineExceeded("Request deadline exceeded before detection")
+
+        flight, results = self.run_with_waiter(expire, lambda: 'faces')
+        self.assertIsInstance(results['leader'], analyzer.DeadlineExceeded)
+        # The waiter runs the computation itself instead of failing with the leader's deadline
+        self.assertEqual(results['waiter'], 'faces')
+        self.assertEqual(flight.leaders, 2)
+
+    def test_other_failures_are_shared(self):
+        def fail():
+            raise ValueError("Unable to decode image")
+
+        _, results = self.run_with_waiter(fail, lambda: 'faces')
+        self.assertIsInstance(results['leader'], ValueError)
+        self.assertIsInstance(results['waiter'], ValueError)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import threading
+import unittest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import deploy
+
+REGISTRY = '722568544242.dkr.ecr.us-east-1.amazonaws.com'
+DIGEST = 'sha256:' + 'a' * 64
+OTHER_DIGEST = 'sha256:' + 'b' * 64
+ENDPOINTS = list(deploy.endpoint_names('dev'))
+
+def missing(operation):
+    return ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Could not find'}}, operation)
+
+class FakeClock:
+    """Monotonic clock that only moves when the poller sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+class FakeSageMaker:
+    """In-memory SageMaker whose endpoints settle after a few describe_endpoint calls.
+
+    Like SageMaker, a failed create leaves the endpoint Failed, while a failed update is
+    rolled back to InService on the previous config with a FailureReason.
+    """
+
+    def __init__(self, existing=(), final_status=None, digests=None, stuck=(), settle_polls=3):
+        self.endpoints = {
+            name: {'EndpointStatus': 'InService', 'EndpointConfigName': f'{name}-old'} for name in existing
+        }
+        self.final_status = final_status or {}
+        self.digests = digests or {}
+        self.stuck = stuck
+        self.settle_polls = settle_polls
+        self.polls = {}
+        self.models = {}
+        self.created = []
+        self.updated = []
+        self.lock = threading.Lock()
+
+    def describe_model(self, ModelName):
+        if ModelName not in self.models:
+            raise missing('DescribeModel')
+        return self.models[ModelName]
+
+    def delete_model(self, ModelName):
+        del self.models[ModelName]
+
+    def create_model(self, **kwargs):
+        self.models[kwargs['ModelName']] = kwargs
+        return {'ModelArn': f"arn:aws:sagemaker:us-east-1:722568544242:model/{kwargs['ModelName']}"}
+
+    def create_endpoint_config(self, **kwargs):
+        return {}
+
+    def create_endpoint(self, EndpointName, EndpointConfigName):
+        with self.lock:
+            self.created.append(EndpointName)
+            self._start(EndpointName, 'Creating', EndpointConfigName)
+
+    def update_endpoint(self, EndpointName, EndpointConfigName):
+        with self.lock:
+            self.updated.append(EndpointName)
+            self._start(EndpointName, 'Updating', EndpointConfigName)
+
+    def _start(self, name, status, config_name):
+        previous = self.endpoints.get(name, {}).get('EndpointConfigName')
+        self.endpoints[name] = {'EndpointStatus': status, 'EndpointConfigName': config_name, 'previous': previous}
+        self.polls[name] = 0
+
+    def describe_endpoint(self, EndpointName):
+        with self.lock:
+            if EndpointName not in self.endpoints:
+                raise missing('DescribeEndpoint')
+            endpoint = self.endpoints[EndpointName]
+            if endpoint['EndpointStatus'] in ('Creating', 'Updating') and EndpointName not in self.stuck:
+                self.polls[EndpointName] += 1
+                if self.polls[EndpointName] >= self.settle_polls:
+                    endpoint['EndpointStatus'] = 'InService'
+                    if self.final_status.get(EndpointName) == 'Failed':
+                        endpoint['FailureReason'] = 'The primary container did not pass the ping health check'
+                        if endpoint['previous'] is None:
+                            endpoint['EndpointStatus'] = 'Failed'
+                        else:
+                            endpoint['EndpointConfigName'] = endpoint['previous']
+            image = f"{REGISTRY}/defender-image-analyzer@{self.digests.get(EndpointName, DIGEST)}"
+            response = {key: value for key, value in endpoint.items() if key != 'previous'}
+            return {**response, 'ProductionVariants': [{'DeployedImages': [{'ResolvedImage': image}]}]}
+
+class FakeECR:
+    def describe_images(self, repositoryName, imageIds):
+        return {'imageDetails': [{'imageDigest': DIGEST}]}
+
+class TestDeploy(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.poller = deploy.Poller(initial=1, maximum=5, timeout=60, sleep=self.clock.sleep, clock=self.clock)
+
+    def deploy(self, sagemaker, image_digest=DIGEST):
+        return deploy.deploy(sagemaker, FakeECR(), ['dev'], image_digest, REGISTRY, 'role', self.poller)
+
+    def test_creates_missing_and_updates_existing_endpoints(self):
+        sagemaker = FakeSageMaker(existing=[ENDPOINTS[0]])
+        results = self.deploy(sagemaker, image_digest=None)
+        self.assertEqual(sagemaker.updated, [ENDPOINTS[0]])
+        self.assertEqual(sagemaker.created, [ENDPOINTS[1]])
+        self.assertTrue(all(ok for ok, _ in results.values()), results)
+        model = sagemaker.models['defenderImageAnalyzer']
+        self.assertEqual(model['PrimaryContainer']['Image'], f'{REGISTRY}/defender-image-analyzer@{DIGEST}')
+
+    def test_failed_update_reports_the_rollback_reason(self):
+        sagemaker = FakeSageMaker(existing=ENDPOINTS, final_status={ENDPOINTS[1]: 'Failed'})
+        results = self.deploy(sagemaker)
+        self.assertTrue(results[ENDPOINTS[0]][0])
+        ok, message = results[ENDPOINTS[1]]
+        self.assertFalse(ok)
+        self.assertIn('rolled back', message)
+        self.assertIn('ping health check', message)
+        # It stops polling once the rollback settles instead of waiting for the timeout
+        self.assertLess(self.clock(), self.poller.timeout)
+
+    def test_failed_create_reports_its_reason(self):
+        sagemaker = FakeSageMaker(final_status={ENDPOINTS[0]: 'Failed'})
+        results = self.deploy(sagemaker)
+        ok, message = results[ENDPOINTS[0]]
+        self.assertFalse(ok)
+        self.assertIn('failed: The primary container did not pass the ping health check', message)
+        self.assertTrue(results[ENDPOINTS[1]][0])
+
+    def test_digest_mismatch_fails_the_endpoint(self):
+        sagemaker = FakeSageMaker(existing=ENDPOINTS, digests={ENDPOINTS[0]: OTHER_DIGEST})
+        results = self.deploy(sagemaker)
+        ok, message = results[ENDPOINTS[0]]
+        self.assertFalse(ok)
+        self.assertIn('mismatch', message)
+        self.assertIn(OTHER_DIGEST, message)
+        self.assertTrue(results[ENDPOINTS[1]][0])
+
+    def test_endpoint_that_never_settles_times_out(self):
+        sagemaker = FakeSageMaker(existing=ENDPOINTS, stuck=[ENDPOINTS[1]])
+        results = self.deploy(sagemaker)
+        self.assertTrue(results[ENDPOINTS[0]][0])
+        ok, message = results[ENDPOINTS[1]]
+        self.assertFalse(ok)
+        self.assertIn('Timed out', message)
+
+class TestPoller(unittest.TestCase):
+    def test_backs_off_up_to_the_maximum(self):
+        clock = FakeClock()
+        delays = []
+
+        def sleep(seconds):
+            delays.append(seconds)
+            clock.sleep(seconds)
+
+        poller = deploy.Poller(initial=2, maximum=10, factor=2, timeout=3600, sleep=sleep, clock=clock)
+        calls = iter(range(10))
+        self.assertEqual(poller.until(lambda: next(calls), lambda n: n == 6, 'six calls'), 6)
+        self.assertEqual(len(delays), 6)
+        # Each delay is within the +-20% jitter of 2, 4, 8, 10, 10, 10
+        for delay, base in zip(delays, [2, 4, 8, 10, 10, 10]):
+            self.assertTrue(0.8 * base <= delay <= 1.2 * base, delays)
+
+    def test_times_out(self):
+        clock = FakeClock()
+        poller = deploy.Poller(initial=1, maximum=1, timeout=5, sleep=clock.sleep, clock=clock)
+        with self.assertRaises(TimeoutError):
+            poller.until(lambda: None, lambda result: result is not None, 'nothing')
+        self.assertLessEqual(clock(), 5 * 1.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'image-analyzer.py')
+
+def load_analyzer():
+    """Import image-analyzer.py, whose file name is not a module name, without warming up the models"""
+    os.environ['WARMUP'] = '0'
+    spec = importlib.util.spec_from_file_location('image_analyzer', ANALYZER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+analyzer = load_analyzer()
+analyzer.JOB_POLL_S = 0.01
+
+class NoSuchKey(Exception):
+    pass
+
+class FakeS3:
+    """put_object / get_object of an in-memory bucket"""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class TestFilesystemJobQueue(TempDirTestCase):
+    def test_jobs_are_claimed_in_order_and_removed_when_done(self):
+        job_queue = analyzer.FilesystemJobQueue(self.directory)
+        job_queue.put('1700000000000-000000000001', {'bucket': 'b', 'key': 'a.jpg'})
+        job_queue.put('1700000000000-000000000002', {'bucket': 'b', 'key': 'b.jpg'})
+        self.assertEqual(job_queue.get(timeout=0), ('1700000000000-000000000001', {'bucket': 'b', 'key': 'a.jpg'}))
+        self.assertEqual(os.listdir(job_queue.claimed), ['1700000000000-000000000001.json'])
+        job_queue.done('1700000000000-000000000001')
+        job_queue.done('1700000000000-000000000001')  # already gone
+        self.assertEqual(os.listdir(job_queue.claimed), [])
+        self.assertEqual(job_queue.get(timeout=0)[0], '1700000000000-000000000002')
+        self.assertIsNone(job_queue.get(timeout=0.05))
+
+    def test_partially_written_jobs_are_not_claimed(self):
+        job_queue = analyzer.FilesystemJobQueue(self.directory)
+        with open(os.path.join(job_queue.pending, '.1700000000000-000000000001.tmp'), 'w') as f:
+            f.write('{"bucket": ')
+        self.assertIsNone(job_queue.get(timeout=0))
+
+    def test_each_job_is_claimed_by_one_worker(self):
+        job_ids = [f'1700000000000-{i:012x}' for i in range(50)]
+        producer = analyzer.FilesystemJobQueue(self.directory)
+        for job_id in job_ids:
+            producer.put(job_id, {'job': job_id})
+
+        claimed = []
+        lock = threading.Lock()
+
+        def consume():
+            # Every consumer has its own queue object on the shared directory, like a worker
+            job_queue = analyzer.FilesystemJobQueue(self.directory)
+            while True:
+                job = job_queue.get(timeout=0)
+                if job is None:
+                    return
+                with lock:
+                    claimed.append(job[0])
+
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), job_ids)
+
+class TestJobStore(TempDirTestCase):
+    def test_local_documents(self):
+        store = analyzer.JobStore(os.path.join(self.directory, 'jobs'))
+        path = store.write('1700000000000-000000000001', 'status.json', {"status": "queued"})
+        self.assertEqual(path, os.path.join(self.directory, 'jobs', '1700000000000-000000000001', 'status.json'))
+        self.assertEqual(store.read('1700000000000-000000000001', 'status.json'), {"status": "queued"})
+        store.write('1700000000000-000000000001', 'status.json', {"status": "running"})
+        self.assertEqual(store.read('1700000000000-000000000001', 'status.json'), {"status": "running"})
+        self.assertIsNone(store.read('1700000000000-000000000001', 'result.json'))
+        self.assertIsNone(store.read('1700000000000-000000000002', 'status.json'))
+
+    def test_s3_documents(self):
+        s3 = FakeS3()
+        get_s3_client = analyzer.get_s3_client
+        analyzer.get_s3_client = lambda: s3
+        try:
+            store = analyzer.JobStore('s3://results/faces/')
+            location = store.write('1700000000000-000000000001', 'result.json', [{"key": "a.jpg", "faces": []}])
+            self.assertEqual(location, 's3://results/faces/1700000000000-000000000001/result.json')
+            self.assertEqual(json.loads(s3.objects[('results', 'faces/1700000000000-000000000001/result.json')]),
+                             [{"key": "a.jpg", "faces": []}])
+            self.assertEqual(store.read('1700000000000-000000000001', 'result.json'), [{"key": "a.jpg", "faces": []}])
+            self.assertIsNone(store.read('1700000000000-000000000001', 'status.json'))
+        finally:
+            analyzer.get_s3_client = get_s3_client
+
+class TestJobWorkers(TempDirTestCase):
+    def test_unusable_queue_directory_does_not_fail_requests(self):
+        not_a_directory = os.path.join(self.directory, 'file')
+        open(not_a_directory, 'w').close()
+        job_queue = analyzer.JOB_QUEUE
+        analyzer.JOB_QUEUE = os.path.join(not_a_directory, 'queue')
+        try:
+            analyzer.consume_shared_jobs()
+            with self.assertRaises(OSError):
+                analyzer.start_job_workers()
+        finally:
+            analyzer.JOB_QUEUE = job_queue
+
+if __name__ == '__main__':
+    unittest.main()
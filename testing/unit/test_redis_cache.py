@@ -0,0 +1,139 @@
+import importlib.util
+import os
+import socket
+import socketserver
+import threading
+import unittest
+
+ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'image-analyzer.py')
+
+def load_analyzer():
+    """Import image-analyzer.py, whose file name is not a module name, without warming up the models"""
+    os.environ['WARMUP'] = '0'
+    spec = importlib.util.spec_from_file_location('image_analyzer', ANALYZER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+analyzer = load_analyzer()
+
+FACES = [{
+    "facial_area": {"x": 10, "y": 20, "w": 64, "h": 64, "left_eye": [30, 40], "right_eye": [50, 40]},
+    "face_confidence": 0.99,
+    "embedding": [0.5, -0.25, 0.125]
+}]
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def reply(self, command):
+        name = command[0].upper()
+        if name == b'GET':
+            if command[1] in self.server.failing:
+                return b'-ERR ' + self.server.failing[command[1]] + b'\r\n'
+            value = self.server.store.get(command[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if name == b'SET':
+            self.server.store[command[1]] = command[2]
+        return b'+OK\r\n'
+
+    def handle(self):
+        # Replies are only written once `pipeline` commands have arrived, so a client
+        # that waits for each reply before sending the next command times out
+        commands = []
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            self.server.commands.append(command)
+            if command[0].upper() in (b'AUTH', b'SELECT'):
+                self.wfile.write(b'+OK\r\n')
+                continue
+            commands.append(command)
+            if len(commands) >= self.server.pipeline:
+                self.wfile.write(b''.join(self.reply(command) for command in commands))
+                commands = []
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.store = {}
+        self.failing = {}  # key -> error message of its GET
+        self.commands = []
+        self.pipeline = 1
+
+class TestRedisCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedis()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.remote = analyzer.RedisCache(f'redis://:secret@127.0.0.1:{self.port}/2', timeout=1, retry_after=30)
+        self.cache = analyzer.EmbeddingCache(analyzer.LocalEmbeddingCache(1024 * 1024), self.remote, ttl=60)
+
+    def tearDown(self):
+        connection = getattr(self.remote._local, 'connection', None)
+        if connection is not None:
+            connection[1].close()
+            connection[2].close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_many_pipelines_the_gets(self):
+        self.server.store[b'a'] = self.server.store[b'c'] = analyzer.pack_faces(FACES)
+        self.server.pipeline = 3
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), [FACES, None, FACES])
+        self.assertEqual(self.server.commands, [
+            [b'AUTH', b'secret'], [b'SELECT', b'2'], [b'GET', b'a'], [b'GET', b'b'], [b'GET', b'c']
+        ])
+        # Remote hits are kept in the worker's LRU
+        self.assertEqual(self.cache.get_many(['a', 'c']), [FACES, FACES])
+        self.assertEqual(len(self.server.commands), 5)
+        stats = self.cache.snapshot()
+        self.assertEqual((stats["lookups"], stats["remote_hits"], stats["local_hits"]), (5, 2, 2))
+        self.assertEqual(stats["remote_errors"], 0)
+
+    def test_miss(self):
+        self.assertEqual(self.remote.execute([('GET', 'missing')]), [None])
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(self.remote.errors, 0)
+
+    def test_put_sets_with_ttl(self):
+        self.cache.put('key', FACES)
+        self.assertEqual(self.server.commands[-1], [b'SET', b'key', analyzer.pack_faces(FACES), b'EX', b'60'])
+
+    def test_error_reply_marks_the_server_down(self):
+        self.server.failing[b'key'] = b'WRONGTYPE Operation against a key holding the wrong kind of value'
+        self.assertIsNone(self.remote.execute([('GET', 'key')]))
+        self.assertEqual(self.remote.errors, 1)
+        # Until retry_after has passed the server is not contacted again
+        count = len(self.server.commands)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(len(self.server.commands), count)
+
+    def test_connection_refused_falls_back_to_the_local_cache(self):
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+        cache = analyzer.EmbeddingCache(
+            analyzer.LocalEmbeddingCache(1024 * 1024), analyzer.RedisCache(f'redis://127.0.0.1:{port}', timeout=1)
+        )
+        cache.put('key', FACES)
+        self.assertEqual(cache.get('key'), FACES)
+        self.assertIsNone(cache.get('other'))
+        stats = cache.snapshot()
+        self.assertEqual(stats["local_hits"], 1)
+        self.assertEqual(stats["remote_errors"], 1)
+
+if __name__ == '__main__':
+    unittest.main()